@@ -75,6 +75,48 @@ USER_PASSWORD = {
 MAX_SEARCH_RESULT_NUMBER = 1000
 
 
+### SEARCH_INDEX
+# If SEARCH_INDEX is True, collection search only reads the documents
+# that an index of the terms and annotation types of each collection,
+# kept in WORK_DIR and updated as documents change, shows could match;
+# tools/buildsearchindex.py builds it ahead of the first search.
+# Requires the sqlite3 module. (True if not defined)
+
+#SEARCH_INDEX = True
+
+
+### ANNOTATION_CACHE_SIZE
+# Number of parsed documents the server keeps in memory so that viewing,
+# searching and computing statistics for an unchanged document does not
+# read and parse its files again. (disabled if <= 0)
+
+ANNOTATION_CACHE_SIZE = 32
+
+
+### ANNOTATION_JOURNAL
+# If ANNOTATION_JOURNAL is True, edits are appended to a journal next to
+# the annotation file (DOCUMENT.ann.journal) instead of rewriting the whole
+# file, which makes editing large documents considerably faster. Once the
+# journal exceeds ANNOTATION_JOURNAL_COMPACT_SIZE bytes it is folded back
+# into the annotation file; tools/compactjournal.py does the same on
+# demand. Downloads include the journaled edits, but tools reading
+# annotation files directly do not see the journal, so compact before
+# running them. Journals are read even if this is False.
+
+ANNOTATION_JOURNAL = False
+ANNOTATION_JOURNAL_COMPACT_SIZE = 1024 * 1024
+
+
+### STATS_PROCESSES
+# Number of worker processes tools/warmstats.py uses to compute the
+# document statistics shown in collection listings ahead of the first
+# listing, such as after a bulk import. The server itself computes the
+# statistics missing from the cache without worker processes. (one per
+# CPU core if not defined or None, no worker processes if <= 1)
+
+#STATS_PROCESSES = 4
+
+
 ### ANNOTATION_LOG
 # If ANNOTATION_LOG is defined, the system will log annotator actions into
 # this file.
@@ -13,13 +13,18 @@ Version:    2011-01-25
 
 # TODO: Major re-work, cleaning up and conforming with new server paradigm
 
+import re
+
 from logging import info as log_info
 from codecs import open as codecs_open
+from errno import ENOENT
+from collections import OrderedDict
 from functools import partial
-from os import utime
+from os import stat, utime
+from thread import allocate_lock
 from time import time
 from os.path import join as path_join
-from os.path import basename, splitext
+from os.path import abspath, basename, dirname, splitext
 
 from common import ProtocolError
 from filelock import file_lock
@@ -33,8 +38,29 @@ JOINED_ANN_FILE_SUFF = 'ann'
 PARTIAL_ANN_FILE_SUFF = ['a1', 'a2', 'co', 'rel']
 KNOWN_FILE_SUFF = [JOINED_ANN_FILE_SUFF]+PARTIAL_ANN_FILE_SUFF
 TEXT_FILE_SUFFIX = 'txt'
+# Edits not yet folded into a joined annotation file, see ANNOTATION_JOURNAL
+JOURNAL_FILE_SUFF = JOINED_ANN_FILE_SUFF + '.journal'
 ###
 
+# Number of parsed documents kept in memory by the process for read-only
+# access, see open_cached_annotations (0 to disable)
+try:
+    from config import ANNOTATION_CACHE_SIZE
+except ImportError:
+    ANNOTATION_CACHE_SIZE = 32
+
+# Append edits to a journal next to the annotation file instead of
+# rewriting the file, and the journal size (in bytes) at which the journal
+# is folded back into the annotation file
+try:
+    from config import ANNOTATION_JOURNAL
+except ImportError:
+    ANNOTATION_JOURNAL = False
+try:
+    from config import ANNOTATION_JOURNAL_COMPACT_SIZE
+except ImportError:
+    ANNOTATION_JOURNAL_COMPACT_SIZE = 1024 * 1024
+
 
 class AnnotationLineSyntaxError(Exception):
     def __init__(self, line, line_num, filepath):
@@ -189,9 +215,83 @@ def open_textfile(filename, mode='rU'):
         mode = mode + 'U'
     return codecs_open(filename, mode, encoding='utf8', errors='strict')
 
-def __split_annotation_id(id):
-    import re
-    m = re.match(r'^([A-Za-z]+|#)([0-9]+)(.*?)$', id)
+# Prefix, number and suffix of an annotation id, e.g. "T", "12", "_a"
+ANNOTATION_ID_RE = re.compile(r'^([A-Za-z]+|#)([0-9]+)(.*?)$')
+# An annotation line with a valid id: id, id prefix (None for equivs), data
+# and data tail, the latter starting with the tab separating it from data
+ANNOTATION_LINE_RE = re.compile(r'(([A-Za-z]+|#)[0-9][^\t]*|\*)\t([^\t]*)(.*)',
+        re.DOTALL)
+# Text-bound data in its usual form, anything else gets the full treatment
+TEXTBOUND_DATA_RE = re.compile(r'(\S+) ([0-9]+) ([0-9]+)$', re.UNICODE)
+# Attribute data with and without (old format) a value
+ATTRIBUTE_DATA_RE = re.compile(r'(.+?) (.+?) (.+?)$')
+MODIFIER_DATA_RE = re.compile(r'(.+?) (.+?)$')
+
+def _write_textfile_atomically(path, text):
+    # Write text next to path and rename it over path once it is safely on
+    # disk, so that readers see either the old or the new file in full
+    from os import close, fsync, rename, remove
+    from os.path import dirname
+    from shutil import copymode
+    from tempfile import mkstemp
+
+    directory = dirname(path) or '.'
+    try:
+        tmp_fd, tmp_path = mkstemp(suffix='.tmp', prefix='.' + basename(path),
+                dir=directory)
+    except OSError:
+        # We may be allowed to write to the file but not to create files
+        # next to it, fall back to rewriting it in place
+        with open_textfile(path, 'w') as out_file:
+            out_file.write(text)
+            out_file.flush()
+            fsync(out_file.fileno())
+        return
+    close(tmp_fd)
+
+    try:
+        with open_textfile(tmp_path, 'w') as tmp_file:
+            tmp_file.write(text)
+            tmp_file.flush()
+            fsync(tmp_file.fileno())
+        # mkstemp creates the file readable only by us, keep the permissions
+        # of the file we replace
+        copymode(path, tmp_path)
+        rename(tmp_path, path)
+    except:
+        try:
+            remove(tmp_path)
+        except OSError:
+            from message import Messager
+            Messager.error("Error removing temporary file '%s'" % tmp_path)
+        raise
+
+    # Make the rename itself durable
+    try:
+        from os import open as os_open, O_RDONLY
+        dir_fd = os_open(directory, O_RDONLY)
+    except OSError:
+        return
+    try:
+        fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        close(dir_fd)
+
+def _file_stamp(path):
+    # (mtime, size, inode) of path or None if it does not exist
+    try:
+        path_stat = stat(path)
+    except OSError:
+        return None
+    return (path_stat.st_mtime, path_stat.st_size, path_stat.st_ino)
+
+def _journal_path(ann_path):
+    return ann_path[:-len(JOINED_ANN_FILE_SUFF)] + JOURNAL_FILE_SUFF
+
+def _split_annotation_id(id):
+    m = ANNOTATION_ID_RE.match(id)
     if m is None:
         raise InvalidIdError(id)
     pre, num_str, suf = m.groups()
@@ -206,7 +306,7 @@ def annotation_id_prefix(id):
     return pre
 
 def annotation_id_number(id):
-    return __split_annotation_id(id)[1]
+    return _split_annotation_id(id)[1]
 
 def is_valid_id(id):
     # special case: '*' is acceptable as an "ID"
@@ -216,7 +316,7 @@ def is_valid_id(id):
     try:
         # currently accepting any ID that can be split.
         # TODO: consider further constraints 
-        __split_annotation_id(id)[1]
+        _split_annotation_id(id)[1]
         return True
     except InvalidIdError:
         return False
@@ -290,30 +390,10 @@ class Annotations(object):
     def __init__(self, document, read_only=False):
         #TODO: DOC!
         #TODO: Incorparate file locking! Is the destructor called upon inter crash?
-        from collections import defaultdict
         from os.path import basename, getmtime, getctime
         #from fileinput import FileInput, hook_encoded
 
-        # we should remember this
-        self._document = document
-
-        self.failed_lines = []
-
-        ### Here be dragons, these objects need constant updating and syncing
-        # Annotation for each line of the file
-        self._lines = []
-        # Mapping between annotation objects and which line they occur on
-        # Range: [0, inf.) unlike [1, inf.) which is common for files
-        self._line_by_ann = {}
-        # Maximum id number used for each id prefix, to speed up id generation
-        #XXX: This is effectively broken by the introduction of id suffixes
-        self._max_id_num_by_prefix = defaultdict(lambda : 1)
-        # Annotation by id, not includid non-ided annotations 
-        self._ann_by_id = {}
-        ###
-
-        ## We use some heuristics to find the appropriate annotation files
-        self._read_only = read_only
+        self._init_state(document, read_only)
         input_files = self._select_input_files(document)
 
         if not input_files:
@@ -322,6 +402,7 @@ class Annotations(object):
         # We then try to open the files we got using the heuristics
         #self._file_input = FileInput(openhook=hook_encoded('utf-8'))
         self._input_files = input_files
+        self._init_journal()
 
         # Finally, parse the given annotation file
         try:
@@ -329,6 +410,8 @@ class Annotations(object):
         
             # Sanity checking that can only be done post-parse
             self._sanity()
+            # Only what changes after reading counts as reclassified
+            self._reclassified_ids.clear()
         except UnicodeDecodeError:
             Messager.error('Encoding error reading annotation file: '
                     'nonstandard encoding or binary?', -1)
@@ -340,11 +423,107 @@ class Annotations(object):
                 self._input_files[0].endswith(JOINED_ANN_FILE_SUFF)):
             self.ann_mtime = getmtime(self._input_files[0])
             self.ann_ctime = getctime(self._input_files[0])
+            if (self._journal_files_stamp is not None
+                    and self._journal_files_stamp[1] is not None):
+                # Edits may only have reached the journal
+                self.ann_mtime = max(self.ann_mtime,
+                        getmtime(self._journal_path))
         else:
             # We don't have a single file, just set to epoch for now
             self.ann_mtime = -1
             self.ann_ctime = -1
 
+    def _init_state(self, document, read_only):
+        # The state of an object before any file is read, shared by every
+        # way of creating one (see _AnnotationsReader)
+        from collections import defaultdict
+
+        # we should remember this
+        self._document = document
+
+        self.failed_lines = []
+
+        ### Here be dragons, these objects need constant updating and syncing
+        # Annotation for each line of the file, deleted lines are left as
+        # None until there are enough of them to warrant compacting the list
+        self._lines = []
+        self._deleted_line_count = 0
+        # Mapping between annotation objects and which line they occur on
+        # Range: [0, inf.) unlike [1, inf.) which is common for files, only
+        # counts the deleted lines still in self._lines
+        self._line_by_ann = {}
+        # Maximum id number used for each id prefix and suffix over the
+        # lifetime of the object, to speed up id generation
+        self._max_id_num_by_prefix_and_suffix = defaultdict(int)
+        # Annotation by id, not includid non-ided annotations 
+        self._ann_by_id = {}
+        # Annotations by category (see _ann_category), kept in the order in
+        # which they were added, which is also the order of the lines
+        self._anns_by_category = defaultdict(OrderedDict)
+        # Number of events referring to each trigger id
+        self._event_count_by_trigger = defaultdict(int)
+        # Ids of the text-bounds that are triggers, see get_trigger_ids,
+        # and of those that became or stopped being triggers since the
+        # annotations were read, see get_reclassified_ids
+        self._trigger_ids = set()
+        self._reclassified_ids = set()
+        # What each annotation was indexed by, see update_annotation
+        self._index_keys_by_ann = {}
+        # Ids each annotation depends on and, reversely, the annotations
+        # depending on each id
+        self._deps_by_ann = {}
+        self._dependants_by_id = defaultdict(set)
+        # Equivs by the ids of their entities. Equivs sharing an entity are
+        # merged as they are added, making them disjoint sets of entities
+        # with each equiv standing for its set.
+        self._equivs_by_entity = defaultdict(set)
+        ###
+
+        # Set whenever the annotations stop matching what was read from disk
+        # and thus need to be written out when we exit
+        self._modified = False
+        # Digest of the lines read, for writable objects, to catch changes
+        # made in place without update_annotation, see __exit__
+        self._read_digest = None
+        # Set when the changes can not be expressed as journal records and
+        # the whole annotation file has to be written out
+        self._rewrite = False
+
+        ## We use some heuristics to find the appropriate annotation files
+        self._read_only = read_only
+        self.ann_line_num = -1
+
+    def _init_journal(self):
+        from os.path import isfile
+
+        # The journal of the annotation file, if it is a joined one. Lines
+        # are identified in the journal by their position in the annotation
+        # file, or after it for lines added by the journal, which never
+        # changes as lines are deleted.
+        self._journal_path = None
+        # Whether we can append to the journal and what the annotation file
+        # and journal looked like when we read them
+        self._journal_appendable = True
+        self._journal_base_digest = None
+        self._journal_files_stamp = None
+        self._journal_line_positions = []
+        self._journal_next_pos = 0
+        self._journal_pos_by_ann = {}
+        # The lines as read or last written by position, for writable
+        # objects, to catch changes made in place without update_annotation
+        # that the journal would otherwise not record, see __exit__
+        self._journal_read_lines = {}
+        # Changed lines by position, None for deleted lines
+        self._journal_changes = {}
+        self._journal_added = set()
+
+        if (len(self._input_files) == 1 and
+                self._input_files[0].endswith('.' + JOINED_ANN_FILE_SUFF)):
+            # Journals are read even if we don't write to them
+            journal_path = _journal_path(self._input_files[0])
+            if ANNOTATION_JOURNAL or isfile(journal_path):
+                self._journal_path = journal_path
+
     def _sanity(self):
         # Beware, we ONLY do format checking, leave your semantics hat at home
 
@@ -361,45 +540,48 @@ class Annotations(object):
                 raise EventWithoutTriggerError(e_ann)
 
         # Check that every trigger is only referenced by events
-        for tr_ann in self.get_triggers():
-            for ann in (a for a in self if a is not tr_ann):
-                # We can't really know how to access all ID;s held by an
-                # annotation so we hook ourselves into the dependencies
-                soft_deps, hard_deps = ann.get_deps()
-                if tr_ann.id in soft_deps or tr_ann.id in hard_deps:
-                    if not isinstance(ann, EventAnnotation):
-                        raise TriggerReferenceError(tr_ann, ann)
+        for tr_ann in (self.get_ann_by_id(tr_id) for tr_id, count
+                in self._event_count_by_trigger.iteritems() if count):
+            # We can't really know how to access all ID;s held by an
+            # annotation so we hook ourselves into the dependencies
+            for ann in self.get_dependants(tr_ann.id):
+                if ann is not tr_ann and not isinstance(ann, EventAnnotation):
+                    raise TriggerReferenceError(tr_ann, ann)
         
+    def _get_by_category(self, category):
+        # Iterate over a snapshot, callers may delete as they go
+        return (a for a in self._anns_by_category[category].keys())
+
     def get_events(self):
-        return (a for a in self if isinstance(a, EventAnnotation))
+        return self._get_by_category(EventAnnotation)
     
     def get_attributes(self):
-        return (a for a in self if isinstance(a, AttributeAnnotation))
+        return self._get_by_category(AttributeAnnotation)
 
     def get_equivs(self):
-        return (a for a in self if isinstance(a, EquivAnnotation))
+        return self._get_by_category(EquivAnnotation)
 
     def get_textbounds(self):
-        return (a for a in self if isinstance(a, TextBoundAnnotation))
+        return self._get_by_category(TextBoundAnnotation)
 
     def get_relations(self):
-        return (a for a in self if isinstance(a, BinaryRelationAnnotation))
+        return self._get_by_category(BinaryRelationAnnotation)
 
     def get_entities(self):
-        # Entities are textbounds that are not triggers
-        triggers = [t for t in self.get_triggers()]
-        return (a for a in self if (isinstance(a, TextBoundAnnotation) and
-                                    not a in triggers))
+        # Entities are textbounds that are not triggers, decided up front
+        # since adding events while iterating can turn entities into triggers
+        return iter([a for a in self.get_textbounds()
+                if a.id not in self._trigger_ids])
     
     def get_oneline_comments(self):
         #XXX: The status exception is for the document status protocol
         #       which is yet to be formalised
-        return (a for a in self if isinstance(a, OnelineCommentAnnotation)
-                and a.type != 'STATUS')
+        return (a for a in self._get_by_category(OnelineCommentAnnotation)
+                if a.type != 'STATUS')
 
     def get_statuses(self):
-        return (a for a in self if isinstance(a, OnelineCommentAnnotation)
-                and a.type == 'STATUS')
+        return (a for a in self._get_by_category(OnelineCommentAnnotation)
+                if a.type == 'STATUS')
 
     def get_triggers(self):
         # Triggers are text-bounds referenced by events
@@ -407,6 +589,133 @@ class Annotations(object):
         # (for one reason or another -- brat shouldn't define any.)
         return (self.get_ann_by_id(e.trigger) for e in self.get_events())
 
+    def get_trigger_ids(self):
+        '''
+        Return the set of ids of the text-bound annotations that are
+        triggers, i.e. referenced by at least one event. Unlike
+        get_triggers, which yields the trigger of every event, each trigger
+        is included once.
+        The set is maintained as annotations are added, deleted and
+        updated; do not modify it.
+        '''
+        return self._trigger_ids
+
+    def get_reclassified_ids(self):
+        '''
+        Return the set of ids of the text-bound annotations that became or
+        stopped being triggers (see get_trigger_ids) as events were added,
+        deleted or updated since the annotations were read; do not modify
+        it.
+        '''
+        return self._reclassified_ids
+
+    def _set_trigger(self, tb_id, is_trigger):
+        if is_trigger != (tb_id in self._trigger_ids):
+            self._reclassified_ids.add(tb_id)
+            if is_trigger:
+                self._trigger_ids.add(tb_id)
+            else:
+                self._trigger_ids.discard(tb_id)
+
+    def _refresh_trigger(self, tb_ann):
+        tb_id = self._index_keys_by_ann[tb_ann]
+        self._set_trigger(tb_id, bool(self._event_count_by_trigger.get(tb_id)))
+
+    def _refresh_trigger_by_id(self, tb_id):
+        tb_ann = self._ann_by_id.get(tb_id)
+        if tb_ann is not None and isinstance(tb_ann, TextBoundAnnotation):
+            self._refresh_trigger(tb_ann)
+
+    def _index_annotation(self, ann):
+        # Index what can change on an annotation after it has been added,
+        # remembering the keys so that the entries can be removed later
+        soft_deps, hard_deps = ann.get_deps()
+        deps = soft_deps | hard_deps
+        if deps:
+            self._deps_by_ann[ann] = deps
+            for dep_id in deps:
+                self._dependants_by_id[dep_id].add(ann)
+
+        if isinstance(ann, TextBoundAnnotation):
+            self._index_keys_by_ann[ann] = ann.id
+            self._refresh_trigger(ann)
+        elif isinstance(ann, EventAnnotation):
+            self._index_keys_by_ann[ann] = ann.trigger
+            self._event_count_by_trigger[ann.trigger] += 1
+            self._refresh_trigger_by_id(ann.trigger)
+        elif isinstance(ann, EquivAnnotation):
+            keys = tuple(ann.entities)
+            self._index_keys_by_ann[ann] = keys
+            for ent in keys:
+                self._equivs_by_entity[ent].add(ann)
+
+    def _unindex_annotation(self, ann):
+        for dep_id in self._deps_by_ann.pop(ann, ()):
+            dependants = self._dependants_by_id[dep_id]
+            dependants.discard(ann)
+            if not dependants:
+                del self._dependants_by_id[dep_id]
+
+        try:
+            keys = self._index_keys_by_ann.pop(ann)
+        except KeyError:
+            # Nothing was indexed for this annotation
+            return
+
+        if isinstance(ann, TextBoundAnnotation):
+            self._set_trigger(keys, False)
+        elif isinstance(ann, EventAnnotation):
+            trigger = keys
+            self._event_count_by_trigger[trigger] -= 1
+            if not self._event_count_by_trigger[trigger]:
+                del self._event_count_by_trigger[trigger]
+            self._refresh_trigger_by_id(trigger)
+        elif isinstance(ann, EquivAnnotation):
+            for ent in keys:
+                equivs = self._equivs_by_entity[ent]
+                equivs.discard(ann)
+                if not equivs:
+                    del self._equivs_by_entity[ent]
+
+    def get_dependants(self, id):
+        '''
+        Return the annotations that depend on (refer to) the annotation with
+        the given id, in the order in which they occur.
+        '''
+        dependants = self._dependants_by_id.get(unicode(id))
+        if not dependants:
+            return []
+        return sorted(dependants, key=self._line_by_ann.__getitem__)
+
+    def update_annotation(self, ann):
+        '''
+        Notify the annotation object that ann, which has already been
+        added, was modified in place (e.g. a new type, trigger or
+        arguments) so that the internal indexes can be brought up to date.
+
+        Argument(s):
+        ann - an annotation previously passed to add_annotation
+        '''
+        if self._read_only:
+            raise AnnotationsIsReadOnlyError(self.get_document())
+        self._update_annotation(ann)
+
+    def _update_annotation(self, ann):
+        # update_annotation, also used to merge equivs as they are read
+        self._unindex_annotation(ann)
+        self._index_annotation(ann)
+        self._modified = True
+        pos = self._journal_pos_by_ann.get(ann)
+        if pos is not None:
+            self._journal_changes[pos] = ann
+
+    def is_modified(self):
+        '''
+        Return True if the annotations were added to, deleted from or
+        updated since they were read from disk.
+        '''
+        return self._modified
+
     # TODO: getters for other categories of annotations
     #TODO: Remove read and use an internal and external version instead
     def add_annotation(self, ann, read=False):
@@ -416,34 +725,29 @@ class Annotations(object):
         if not read and self._read_only:
             raise AnnotationsIsReadOnlyError(self.get_document())
 
-        # Equivs have to be merged with other equivs
-        try:
-            # Bail as soon as possible for non-equivs
-            ann.entities # TODO: what is this?
+        # Equivs have to be merged with the equivs sharing entities with
+        # them, which we merge in the order of their lines into the last one
+        if isinstance(ann, EquivAnnotation):
+            overlapping = set()
+            for ent in ann.entities:
+                overlapping.update(self._equivs_by_entity.get(ent, ()))
+
             merge_cand = ann
-            for eq_ann in self.get_equivs():
-                try:
-                    # Make sure that this Equiv duck quacks
-                    eq_ann.entities
-                except AttributeError, e:
-                    assert False, 'got a non-entity from an entity call'
-
-                # Do we have an entitiy in common with this equiv?
-                for ent in merge_cand.entities:
-                    if ent in eq_ann.entities:
-                        for m_ent in merge_cand.entities:
-                            if m_ent not in eq_ann.entities: 
-                                eq_ann.entities.append(m_ent)
-                        # Don't try to delete ann since it never was added
-                        if merge_cand != ann:
-                            try:
-                                self.del_annotation(merge_cand)
-                            except DependingAnnotationDeleteError:
-                                assert False, ('Equivs lack ids and should '
-                                        'never have dependent annotations')
-                        merge_cand = eq_ann
-                        # We already merged it all, break to the next ann
-                        break
+            for eq_ann in sorted(overlapping, key=self._line_by_ann.get):
+                eq_entities = set(eq_ann.entities)
+                for m_ent in merge_cand.entities:
+                    if m_ent not in eq_entities:
+                        eq_ann.entities.append(m_ent)
+                        eq_entities.add(m_ent)
+                self._update_annotation(eq_ann)
+                # Don't try to delete ann since it never was added
+                if merge_cand != ann:
+                    try:
+                        self.del_annotation(merge_cand)
+                    except DependingAnnotationDeleteError:
+                        assert False, ('Equivs lack ids and should '
+                                'never have dependent annotations')
+                merge_cand = eq_ann
 
             if merge_cand != ann:
                 # The proposed annotation was simply merged, no need to add it
@@ -452,23 +756,35 @@ class Annotations(object):
                 self.ann_mtime = time()
                 return
 
-        except AttributeError:
-            #XXX: This can catch a ton more than we want to! Ugly!
-            # It was not an Equiv, skip along
-            pass
-
         # Register the object id
         try:
             self._ann_by_id[ann.id] = ann
-            pre, num = annotation_id_prefix(ann.id), annotation_id_number(ann.id)
-            self._max_id_num_by_prefix[pre] = max(num, self._max_id_num_by_prefix[pre])
+            pre, num_str, suf = _split_annotation_id(ann.id)
+            num = int(num_str)
+            if num > self._max_id_num_by_prefix_and_suffix[(pre, suf)]:
+                self._max_id_num_by_prefix_and_suffix[(pre, suf)] = num
         except AttributeError:
             # The annotation simply lacked an id which is fine
             pass
+        except InvalidIdError:
+            # Unparsed lines may carry ids we can not generate, fine too
+            pass
 
         # Add the annotation as the last line
+        self._line_by_ann[ann] = len(self._lines)
         self._lines.append(ann)
-        self._line_by_ann[ann] = len(self) - 1
+        category = _ann_category(ann)
+        if category is not None:
+            self._anns_by_category[category][ann] = True
+        self._index_annotation(ann)
+        if not read:
+            self._modified = True
+            if self._journal_path is not None:
+                pos = self._journal_next_pos
+                self._journal_next_pos += 1
+                self._journal_pos_by_ann[ann] = pos
+                self._journal_changes[pos] = ann
+                self._journal_added.add(pos)
         # Update the modification time
         from time import time
         self.ann_mtime = time()
@@ -496,13 +812,8 @@ class Annotations(object):
             return
 
         # collect annotations dependending on ann
-        ann_deps = []
+        ann_deps = self.get_dependants(ann.id)
 
-        for other_ann in self:
-            soft_deps, hard_deps = other_ann.get_deps()
-            if unicode(ann.id) in soft_deps | hard_deps:
-                ann_deps.append(other_ann)
-              
         # If all depending are AttributeAnnotations or EquivAnnotations,
         # delete all modifiers recursively (without confirmation) and remove
         # the annotation id from the equivs (and remove the equiv if there is
@@ -530,6 +841,7 @@ class Annotations(object):
                         if tracker is not None:
                             before = unicode(d)
                         d.entities.remove(unicode(ann.id))
+                        self.update_annotation(d)
                         if tracker is not None:
                             tracker.change(before, d)
                 elif isinstance(d, OnelineCommentAnnotation):
@@ -556,14 +868,22 @@ class Annotations(object):
             pass
 
         ann_line = self._line_by_ann[ann]
-        # Erase the main annotation
-        del self._lines[ann_line]
+        category = _ann_category(ann)
+        if category is not None:
+            del self._anns_by_category[category][ann]
+        self._unindex_annotation(ann)
+        # Erase the main annotation, leaving the line numbers of every
+        # annotation after this one intact until we compact
+        self._lines[ann_line] = None
+        self._deleted_line_count += 1
         # Erase the ann by line shorthand
         del self._line_by_ann[ann]
-        # Update the line shorthand of every annotation after this one
-        # to reflect the new self._lines
-        for l_num in xrange(ann_line, len(self)):
-            self._line_by_ann[self[l_num]] = l_num
+        if self._deleted_line_count > len(self._lines) / 2:
+            self._compact_lines()
+        self._modified = True
+        pos = self._journal_pos_by_ann.pop(ann, None)
+        if pos is not None:
+            self._journal_changes[pos] = None
         # Update the modification time
         from time import time
         self.ann_mtime = time()
@@ -578,7 +898,7 @@ class Annotations(object):
     def get_new_id(self, prefix, suffix=None):
         '''
         Return a new valid unique id for this annotation file for the given
-        prefix. No ids are re-used for traceability over time for annotations,
+        prefix and suffix. No ids are re-used for traceability over time for annotations,
         but this only holds for the lifetime of the annotation object. If the
         annotation file is parsed once again into an annotation object the
         next assigned id will be the maximum seen for a given prefix plus one
@@ -590,31 +910,27 @@ class Annotations(object):
         order to reserve it.
 
         Argument(s):
-        id_pre - an annotation prefix on the format [A-Za-z]+
+        prefix - an annotation prefix on the format [A-Za-z]+
+        suffix - an optional annotation suffix, e.g. "_a"
 
         Returns:
         An id that is guaranteed to be unique for the lifetime of the
         annotation.
         '''
-        #XXX: We have changed this one radically!
-        #XXX: Stupid and linear
         if suffix is None:
             suffix = ''
-        #XXX: Arbitary constant!
-        for suggestion in (prefix + unicode(i) + suffix for i in xrange(1, 2**15)):
-            # This is getting more complicated by the minute, two checks since
-            # the developers no longer know when it is an id or string.
-            if suggestion not in self._ann_by_id:
-                return suggestion
+        num = self._max_id_num_by_prefix_and_suffix[(prefix, suffix)] + 1
+        # Ids registered in another form, e.g. "T01" for 1, may still collide
+        while prefix + unicode(num) + suffix in self._ann_by_id:
+            num += 1
+        return prefix + unicode(num) + suffix
 
     # XXX: This syntax is subject to change
     def _parse_attribute_annotation(self, id, data, data_tail, input_file_path):
-        import re
-
-        match = re.match(r'(.+?) (.+?) (.+?)$', data)
+        match = ATTRIBUTE_DATA_RE.match(data)
         if match is None:
             # Is it an old format without value?
-            match = re.match(r'(.+?) (.+?)$', data)
+            match = MODIFIER_DATA_RE.match(data)
 
             if match is None:
                 raise IdedAnnotationLineSyntaxError(id, self.ann_line,
@@ -697,6 +1013,11 @@ class Annotations(object):
         return AttributeAnnotation(target, id, type, data_tail, True, source_id=input_file_path)
 
     def _split_textbound_data(self, id, data, input_file_path):
+        match = TEXTBOUND_DATA_RE.match(data)
+        if match is not None:
+            type, start_str, end_str = match.groups()
+            return type, int(start_str), int(end_str)
+
         try:
             type, start_str, end_str = data.split(None, 2)
             # ignore trailing whitespace
@@ -722,102 +1043,380 @@ class Annotations(object):
             raise IdedAnnotationLineSyntaxError(id, self.ann_line, self.ann_line_num+1, input_file_path)
         return OnelineCommentAnnotation(target, id, type, data_tail, source_id=input_file_path)
     
-    def _parse_ann_file(self):
-        from itertools import takewhile
+    def _split_ann_line(self, input_file_path):
+        # The slow path of splitting a line into id, id prefix, data and data
+        # tail, which reports exactly what is wrong with it
+        try:
+            id, id_tail = self.ann_line.split('\t', 1)
+        except ValueError:
+            raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
+
+        pre = annotation_id_prefix(id)
+
+        if id in self._ann_by_id and pre != '*':
+            raise DuplicateAnnotationIdError(id,
+                    self.ann_line, self.ann_line_num+1,
+                    input_file_path)
 
+        # if the ID is not valid, need to fail with
+        # AnnotationLineSyntaxError (not
+        # IdedAnnotationLineSyntaxError).
+        if not is_valid_id(id):
+            raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
+
+        # Cases for lines
+        try:
+            data_delim = id_tail.index('\t')
+            data, data_tail = (id_tail[:data_delim],
+                    id_tail[data_delim:])
+        except ValueError:
+            data = id_tail
+            # No tail at all, although it should have a \t
+            data_tail = ''
+        return id, pre, data, data_tail
+
+    def _parse_ann_file(self):
+        from hashlib import md5
+
+        read_digest = md5() if not self._read_only else None
+        read_lines = []
+        for new_ann, failed in self._iter_parsed_lines():
+            self.add_annotation(new_ann, read=True)
+            if failed:
+                # NOTE: For access we start at line 0, not 1 as in files
+                self.failed_lines.append(self.ann_line_num)
+            if read_digest is not None:
+                read_line = self.ann_line.rstrip(u'\r\n')
+                read_digest.update(read_line.encode('utf-8') + '\n')
+                if self._journal_path is not None:
+                    read_lines.append(read_line)
+        if read_digest is not None:
+            self._read_digest = read_digest.hexdigest()
+
+        if self._journal_path is not None and not self._read_only:
+            if (not self._deleted_line_count and
+                    len(self._lines) == len(self._journal_line_positions)):
+                self._journal_pos_by_ann = dict(
+                        zip(self._lines, self._journal_line_positions))
+                self._journal_read_lines = dict(
+                        zip(self._journal_line_positions, read_lines))
+            else:
+                # Some lines were merged while reading, we can no longer
+                # tell which line is where
+                self._modified = True
+                self._rewrite = True
+        self._journal_line_positions = []
+
+    def _iter_parsed_lines(self, kinds=None):
+        # Parse the lines of the input files, yielding the annotation for
+        # each along with whether the line failed to parse. With kinds, only
+        # yield the lines parsed by the parsers for the given keys below.
         self.ann_line_num = -1
         for input_file_path in self._input_files:
             with open_textfile(input_file_path) as input_file:
-                #for self.ann_line_num, self.ann_line in enumerate(self._file_input):
-                for self.ann_line in input_file:
-                    self.ann_line_num += 1
-                    try:
-                        # ID processing
-                        try:
-                            id, id_tail = self.ann_line.split('\t', 1)
-                        except ValueError:
-                            raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        pre = annotation_id_prefix(id)
-
-                        if id in self._ann_by_id and pre != '*':
-                            raise DuplicateAnnotationIdError(id,
-                                    self.ann_line, self.ann_line_num+1,
-                                    input_file_path)
-
-                        # if the ID is not valid, need to fail with
-                        # AnnotationLineSyntaxError (not
-                        # IdedAnnotationLineSyntaxError).
-                        if not is_valid_id(id):
-                            raise AnnotationLineSyntaxError(self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        # Cases for lines
-                        try:
-                            data_delim = id_tail.index('\t')
-                            data, data_tail = (id_tail[:data_delim],
-                                    id_tail[data_delim:])
-                        except ValueError:
-                            data = id_tail
-                            # No tail at all, although it should have a \t
-                            data_tail = ''
-
-                        new_ann = None
-
-                        #log_info('Will evaluate prefix: ' + pre)
-
-                        if pre == '*':
-                            new_ann = self._parse_equiv_annotation(
-                                    data, data_tail, input_file_path)
-                        elif pre == 'E':
-                            new_ann = self._parse_event_annotation(
-                                    id, data, data_tail, input_file_path)
-                        elif pre == 'M':
-                            new_ann = self._parse_modifier_annotation(
-                                    id, data, data_tail, input_file_path)
-
-                        # XXX: This syntax is subject to change, limit to only T?
-                        elif pre.startswith('T'):
-                            new_ann = self._parse_textbound_annotation(
-                                    id, data, data_tail, input_file_path)
-                        elif pre == '#':
-                            new_ann = self._parse_comment_line(
-                                    id, data, data_tail, input_file_path)
-                        elif pre == 'R':
-                            new_ann = self._parse_relation_annotation(
-                                    id, data, data_tail, input_file_path)
-                        elif pre.startswith('A'):
-                            new_ann = self._parse_attribute_annotation(
-                                    id, data, data_tail, input_file_path)
-                        else:
-                            raise IdedAnnotationLineSyntaxError(id, self.ann_line, self.ann_line_num+1, input_file_path)
-
-                        assert new_ann is not None, "INTERNAL ERROR"
-                        self.add_annotation(new_ann, read=True)
-                    except IdedAnnotationLineSyntaxError, e:
-                        # Could parse an ID but not the whole line; add UnparsedIdedAnnotation
-                        self.add_annotation(UnparsedIdedAnnotation(e.id,
-                            e.line, source_id=e.filepath), read=True)
-                        self.failed_lines.append(e.line_num - 1)
-
-                    except AnnotationLineSyntaxError, e:
-                        # We could not parse even an ID on the line, just add it as an unknown annotation
-                        self.add_annotation(UnknownAnnotation(e.line,
-                            source_id=e.filepath), read=True)
-                        # NOTE: For access we start at line 0, not 1 as in here
-                        self.failed_lines.append(e.line_num - 1)
+                if self._journal_path is not None:
+                    input_lines = self._read_journaled_lines(input_file)
+                else:
+                    input_lines = input_file
+                for parsed in self._parse_lines(input_lines, input_file_path,
+                        kinds):
+                    yield parsed
+
+    def _parse_lines(self, input_lines, input_file_path, kinds=None):
+        # Parse the given lines read from input_file_path, continuing the
+        # line numbering, as for _iter_parsed_lines
+
+        # Line parsers by id prefix, and by the first character of the
+        # prefix for those that allow longer prefixes
+        parsers_by_prefix = {
+                '*': lambda id, data, data_tail, input_file_path: (
+                    self._parse_equiv_annotation(data, data_tail,
+                        input_file_path)),
+                'E': self._parse_event_annotation,
+                'M': self._parse_modifier_annotation,
+                '#': self._parse_comment_line,
+                'R': self._parse_relation_annotation,
+                }
+        # XXX: This syntax is subject to change, limit to only T?
+        parsers_by_prefix_start = {
+                'T': self._parse_textbound_annotation,
+                'A': self._parse_attribute_annotation,
+                }
+
+        #for self.ann_line_num, self.ann_line in enumerate(self._file_input):
+        for self.ann_line in input_lines:
+            self.ann_line_num += 1
+            try:
+                # ID processing, well-formed lines are split in one go
+                match = ANNOTATION_LINE_RE.match(self.ann_line)
+                if match is not None:
+                    id, pre, data, data_tail = match.groups()
+                    if pre is None:
+                        pre = '*'
+                    elif id in self._ann_by_id:
+                        raise DuplicateAnnotationIdError(id,
+                                self.ann_line, self.ann_line_num+1,
+                                input_file_path)
+                else:
+                    id, pre, data, data_tail = self._split_ann_line(
+                            input_file_path)
+
+                #log_info('Will evaluate prefix: ' + pre)
+
+                kind = pre
+                parser = parsers_by_prefix.get(pre)
+                if parser is None:
+                    parser = parsers_by_prefix_start.get(pre[0])
+                    if parser is not None:
+                        kind = pre[0]
+                if kinds is not None and kind not in kinds:
+                    continue
+
+                if parser is None:
+                    raise IdedAnnotationLineSyntaxError(id, self.ann_line, self.ann_line_num+1, input_file_path)
+                new_ann = parser(id, data, data_tail, input_file_path)
+
+                assert new_ann is not None, "INTERNAL ERROR"
+                yield new_ann, False
+            except IdedAnnotationLineSyntaxError, e:
+                # Could parse an ID but not the whole line; add UnparsedIdedAnnotation
+                yield UnparsedIdedAnnotation(e.id, e.line,
+                        source_id=e.filepath), True
+
+            except AnnotationLineSyntaxError, e:
+                # We could not parse even an ID on the line, just add it as an unknown annotation
+                yield UnknownAnnotation(e.line,
+                        source_id=e.filepath), True
+
+    def _read_journaled_lines(self, input_file):
+        # Return the lines of the annotation file with the complete batches
+        # of the journal applied to them, see _journal_records
+        from hashlib import md5
+
+        self._journal_files_stamp = (_file_stamp(input_file.name),
+                _file_stamp(self._journal_path))
+
+        lines = input_file.readlines()
+        digest = md5()
+        for line in lines:
+            digest.update(line.encode('utf-8'))
+        self._journal_base_digest = digest.hexdigest()
+
+        lines_by_pos = OrderedDict(enumerate(lines))
+        self._journal_next_pos = len(lines)
+
+        if self._journal_files_stamp[1] is not None:
+            with open(self._journal_path, 'rb') as journal_file:
+                journal = journal_file.read()
+            self._journal_appendable = self._replay_journal(journal,
+                    lines_by_pos)
+
+        self._journal_line_positions = lines_by_pos.keys()
+        return lines_by_pos.values()
+
+    def _replay_journal(self, journal, lines_by_pos):
+        # Apply the journal to lines_by_pos, returning whether it is fit to
+        # be appended to
+        records = journal.split('\n')
+        if records[0] != '@\t' + self._journal_base_digest:
+            # The annotation file has been rewritten without the journal
+            # being removed, which happens if we stop half-way through
+            Messager.warning('Ignoring outdated annotation journal %s'
+                    % self._journal_path)
+            return False
+
+        batch = []
+        read_size = len(records[0]) + 1
+        # The last record is incomplete, if not empty, and ignored
+        for record in records[1:-1]:
+            read_size += len(record) + 1
+            if record != '.':
+                batch.append(record)
+                continue
+
+            try:
+                ops = []
+                for record in batch:
+                    op, pos, ann_line = (record.decode('utf-8').split('\t', 2)
+                            + [u''])[:3]
+                    if op not in ('+', '=', '-'):
+                        raise ValueError('unknown operation "%s"' % op)
+                    ops.append((op, int(pos), ann_line))
+            except ValueError, e:
+                Messager.error('Error reading annotation journal %s: %s'
+                        % (self._journal_path, e))
+                return False
+
+            for op, pos, ann_line in ops:
+                if op == '-':
+                    lines_by_pos.pop(pos, None)
+                elif op == '+' or pos in lines_by_pos:
+                    lines_by_pos[pos] = ann_line + u'\n'
+                self._journal_next_pos = max(self._journal_next_pos, pos + 1)
+            batch = []
+        # Only append after a complete batch
+        return read_size == len(journal)
+
+    def _journal_records(self):
+        # One record per changed line, in the order of the lines:
+        #   +\tPOSITION\tLINE for added lines
+        #   =\tPOSITION\tLINE for changed lines
+        #   -\tPOSITION for deleted lines
+        records = []
+        out_anns = []
+        out_lines = []
+        for pos in sorted(self._journal_changes):
+            ann = self._journal_changes[pos]
+            if ann is not None:
+                out_anns.append(ann)
+                out_lines.append(unicode(ann).rstrip(u'\r\n'))
+                records.append(u'%s\t%d\t%s' % (
+                    '+' if pos in self._journal_added else '=', pos,
+                    out_lines[-1]))
+            elif pos not in self._journal_added:
+                records.append(u'-\t%d' % pos)
+        self._validate_serialisation(out_anns, out_lines)
+        return records
+
+    def _append_to_journal(self):
+        # Try to write the changes as a batch of journal records, returns
+        # False if the whole annotation file needs to be written instead
+        if (not ANNOTATION_JOURNAL or self._journal_path is None
+                or self._rewrite or not self._journal_appendable):
+            return False
+        # Has anyone else written to the files since we read them?
+        journal_stamp = _file_stamp(self._journal_path)
+        if (_file_stamp(self._input_files[0]), journal_stamp
+                ) != self._journal_files_stamp:
+            return False
+
+        records = self._journal_records()
+        records.append(u'.')
+        if journal_stamp is None:
+            records.insert(0, u'@\t' + self._journal_base_digest)
+        data = (u'\n'.join(records) + u'\n').encode('utf-8')
+
+        journal_size = journal_stamp[1] if journal_stamp is not None else 0
+        if journal_size + len(data) > ANNOTATION_JOURNAL_COMPACT_SIZE:
+            # Time to fold the journal back into the annotation file
+            return False
+
+        from os import fsync
+        with open(self._journal_path, 'ab') as journal_file:
+            journal_file.write(data)
+            journal_file.flush()
+            fsync(journal_file.fileno())
+
+        self._journal_files_stamp = (self._journal_files_stamp[0],
+                _file_stamp(self._journal_path))
+        for pos, ann in self._journal_changes.iteritems():
+            if ann is not None:
+                self._journal_read_lines[pos] = unicode(ann).rstrip(u'\r\n')
+            else:
+                self._journal_read_lines.pop(pos, None)
+        self._journal_changes = {}
+        self._journal_added = set()
+        return True
+
+    def _write_ann_file(self):
+        out_lines = self._serialised_lines()
+        self._validate_serialisation(self, out_lines)
+        out_str = self._join_serialised_lines(out_lines)
+        _write_textfile_atomically(self._input_files[0], out_str)
+        if self._read_digest is not None:
+            self._read_digest = self._lines_digest(out_lines)
+
+        if self._journal_path is not None:
+            # The journal has been folded into what we just wrote
+            from os import remove
+            try:
+                remove(self._journal_path)
+            except OSError, e:
+                if e.errno != ENOENT:
+                    raise
+
+            from hashlib import md5
+            self._journal_base_digest = md5(out_str.encode('utf-8')
+                    ).hexdigest()
+            self._journal_files_stamp = (_file_stamp(self._input_files[0]),
+                    None)
+            self._journal_appendable = True
+            self._journal_next_pos = len(self)
+            if not self._read_only:
+                self._journal_pos_by_ann = dict((ann, pos)
+                        for pos, ann in enumerate(self))
+                self._journal_read_lines = dict(enumerate(out_lines))
+            self._journal_changes = {}
+            self._journal_added = set()
+        self._rewrite = False
+
+    def _serialised_lines(self):
+        return [unicode(ann).rstrip(u'\r\n') for ann in self]
+
+    @staticmethod
+    def _lines_digest(lines):
+        # The digest of serialised lines, as _parse_ann_file computes it for
+        # the lines read
+        from hashlib import md5
+
+        digest = md5()
+        for line in lines:
+            digest.update(line.encode('utf-8') + '\n')
+        return digest.hexdigest()
+
+    def _serialised_digest(self):
+        return self._lines_digest(self._serialised_lines())
+
+    def _changed_in_place(self):
+        # Whether annotations were changed without update_annotation, in
+        # which case we can't tell which lines changed and writing only the
+        # registered changes would lose the others
+        if self._read_digest is None or self._rewrite:
+            return False
+        if (ANNOTATION_JOURNAL and self._journal_path is not None
+                and self._journal_appendable):
+            # The journal will leave the lines without registered changes
+            # as they were read, so these have to be unchanged
+            read_lines = self._journal_read_lines
+            for ann in self:
+                pos = self._journal_pos_by_ann.get(ann)
+                if pos in self._journal_changes:
+                    continue
+                if (pos is None or read_lines.get(pos)
+                        != unicode(ann).rstrip(u'\r\n')):
+                    return True
+            return False
+        # Written out whole if modified at all
+        return (not self._modified
+                and self._serialised_digest() != self._read_digest)
 
     def __str__(self):
-        s = u'\n'.join(unicode(ann).rstrip(u'\r\n') for ann in self)
+        return self._join_serialised_lines(self._serialised_lines())
+
+    @staticmethod
+    def _join_serialised_lines(lines):
+        s = u'\n'.join(lines)
         if not s:
             return u''
         else:
             return s if s[-1] == u'\n' else s + u'\n'
 
-    def __it__(self):
-        for ann in self._lines:
-            yield ann
+    def _compact_lines(self):
+        # Drop the deleted lines and renumber the remaining ones, amortised
+        # over the deletions this is constant time per deletion
+        if not self._deleted_line_count:
+            return
+        self._lines = [ann for ann in self._lines if ann is not None]
+        self._deleted_line_count = 0
+        for l_num, ann in enumerate(self._lines):
+            self._line_by_ann[ann] = l_num
+
+    def __iter__(self):
+        return (ann for ann in self._lines if ann is not None)
 
     def __getitem__(self, val):
+        # Indexing is by line, which requires the deleted lines to be gone
+        self._compact_lines()
         try:
             # First, try to use it as a slice object
             return self._lines[val.start, val.stop, val.step]
@@ -826,7 +1425,7 @@ class Annotations(object):
             return self._lines[val]
 
     def __len__(self):
-        return len(self._lines)
+        return len(self._lines) - self._deleted_line_count
 
     def __enter__(self):
         # No need to do any handling here, the constructor handles that
@@ -837,17 +1436,15 @@ class Annotations(object):
         if not self._read_only:
             assert len(self._input_files) == 1, 'more than one valid outfile'
 
-            # We are hitting the disk a lot more than we should here, what we
-            # should have is a modification flag in the object but we can't
-            # due to how we change the annotations.
-            
-            out_str = unicode(self)
-            with open_textfile(self._input_files[0], 'r') as old_ann_file:
-                old_str = old_ann_file.read()
+            # Whatever happens below, cached copies may be about to go stale
+            _invalidate_cached_annotations(self._document)
+
+            if self._changed_in_place():
+                # We have to write all of the lines out
+                self._modified = True
+                self._rewrite = True
 
-            # Was it changed?
-            if out_str == old_str:
-                # Then just return
+            if not self._modified:
                 return
 
             from config import WORK_DIR
@@ -856,47 +1453,52 @@ class Annotations(object):
             with file_lock(path_join(WORK_DIR,
                     basename(self._input_files[0].replace('/', '_')))
                     ) as lock_file:
-                #from tempfile import NamedTemporaryFile
-                from tempfile import mkstemp
-                # TODO: XXX: Is copyfile really atomic?
-                from shutil import copyfile
-                # XXX: NamedTemporaryFile only supports encoding for Python 3
-                #       so we hack around it.
-                #with NamedTemporaryFile('w', suffix='.ann') as tmp_file:
-                # Grab the filename, but discard the handle
-                _, tmp_fname = mkstemp(suffix='.ann')
-                try:
-                    with open_textfile(tmp_fname, 'w') as tmp_file:
-                        #XXX: Temporary hack to make sure we don't write corrupted
-                        #       files, but the client will already have the version
-                        #       at this stage leading to potential problems upon
-                        #       the next change to the file.
-                        tmp_file.write(out_str)
-                        tmp_file.flush()
-
-                        try:
-                            with Annotations(tmp_file.name) as ann:
-                                # Move the temporary file onto the old file
-                                copyfile(tmp_file.name, self._input_files[0])
-                                # As a matter of convention we adjust the modified
-                                # time of the data dir when we write to it. This
-                                # helps us to make back-ups
-                                now = time()
-                                #XXX: Disabled for now!
-                                #utime(DATA_DIR, (now, now))
-                        except Exception, e:
-                            from message import Messager
-                            Messager.error('ERROR writing changes: generated annotations cannot be read back in!\n(This is almost certainly a system error, please contact the developers.)\n%s' % e, -1)
-                            raise
-                finally:
-                    try:
-                        from os import remove
-                        remove(tmp_fname)
-                    except Exception, e:
-                        from message import Messager
-                        Messager.error("Error removing temporary file '%s'" % tmp_fname)
+                if not self._append_to_journal():
+                    self._write_ann_file()
+                _count_write(self._document)
+                # As a matter of convention we adjust the modified
+                # time of the data dir when we write to it. This
+                # helps us to make back-ups
+                now = time()
+                #XXX: Disabled for now!
+                #utime(DATA_DIR, (now, now))
+            self._modified = False
             return
 
+    def _new_reader(self):
+        # An object parsing lines as this one does, without storing them
+        return _AnnotationsReader(self._document)
+
+    def _validate_serialisation(self, anns, out_lines):
+        # Make sure that we don't write corrupted files by parsing the
+        # serialised line of each of anns as it would be read back in. As
+        # the indexes are maintained as we go, the structure is checked
+        # without re-reading the whole file. The client will however
+        # already have the version at this stage leading to potential
+        # problems upon the next change to the file.
+        try:
+            reader = self._new_reader()
+            for ann, line in zip(anns, out_lines):
+                if isinstance(ann, (UnknownAnnotation,
+                        UnparsedIdedAnnotation)):
+                    # Lines that could not be parsed are kept as they were
+                    continue
+                if u'\n' in line or u'\r' in line:
+                    raise ValueError('annotation spans several lines: %s'
+                            % line)
+                for parsed, failed in reader._parse_lines([line + u'\n'],
+                        self._input_files[0]):
+                    if failed:
+                        raise ValueError('annotation cannot be parsed: %s'
+                                % line)
+                    if not isinstance(parsed, EquivAnnotation):
+                        reader._ann_by_id[parsed.id] = True
+            self._sanity()
+        except Exception, e:
+            from message import Messager
+            Messager.error('ERROR writing changes: generated annotations cannot be read back in!\n(This is almost certainly a system error, please contact the developers.)\n%s' % e, -1)
+            raise
+
     def __in__(self, other):
         #XXX: You should do this one!
         pass
@@ -910,6 +1512,10 @@ class TextAnnotations(Annotations):
     """
     def __init__(self, document, read_only=False):
         # First read the text or the Annotations can't verify the annotations
+        self._load_document_text(document)
+        Annotations.__init__(self, document, read_only)
+
+    def _load_document_text(self, document):
         if document.endswith('.txt'):
             textfile_path = document
         else:
@@ -925,8 +1531,6 @@ class TextAnnotations(Annotations):
         if not document_text:
             raise AnnotationTextFileNotFoundError(document)
         self._document_text = document_text
-        
-        Annotations.__init__(self, document, read_only)
 
     def _parse_textbound_annotation(self, id, data, data_tail, input_file_path):
         type, start, end = self._split_textbound_data(id, data, input_file_path)
@@ -948,6 +1552,9 @@ class TextAnnotations(Annotations):
         if data_tail.strip() == '' and end - start > 0:
             Messager.error(u"Text-bound annotation missing text (expected format 'ID\\tTYPE START END\\tTEXT'). Filling from reference text. NOTE: This changes annotations on disk unless read-only.", "warning")
             text = self._document_text[start:end]
+            # The filled in text needs to be written back
+            self._modified = True
+            self._rewrite = True
         elif data_tail[0] != '\t':
             Messager.error('Text-bound annotation missing tab before text (expected format "ID\\tTYPE START END\\tTEXT").')
             raise IdedAnnotationLineSyntaxError(id, self.ann_line, self.ann_line_num+1, input_file_path)
@@ -976,6 +1583,9 @@ class TextAnnotations(Annotations):
     def get_document_text(self):
         return self._document_text
 
+    def _new_reader(self):
+        return _TextAnnotationsReader(self._document, self._document_text)
+
     def _read_document_text(self, document):
         # TODO: this is too naive; document may be e.g. "PMID.a1",
         # in which case the reasonable text file name guess is
@@ -989,10 +1599,197 @@ class TextAnnotations(Annotations):
             Messager.error('Error reading document text from %s' % textfn)
         return None
 
+class _AnnotationsReader(Annotations):
+    """
+    Annotations that are parsed but never stored, see iter_annotations.
+    """
+    def __init__(self, document):
+        # Only what is needed to parse the lines, _ann_by_id holding the
+        # ids seen so far to detect duplicates
+        self._init_state(document, True)
+
+        self._input_files = self._select_input_files(document)
+        if not self._input_files:
+            raise AnnotationFileNotFoundError(document)
+        self._init_journal()
+
+class _TextAnnotationsReader(_AnnotationsReader, TextAnnotations):
+    """
+    As _AnnotationsReader, but verifies text-bound annotations against
+    the text and gives them access to it as TextAnnotations does.
+    """
+    def __init__(self, document, document_text=None):
+        if document_text is None:
+            self._load_document_text(document)
+        else:
+            self._document_text = document_text
+        _AnnotationsReader.__init__(self, document)
+
+def _merge_equiv(equivs, ann):
+    # Merge ann into the equivs sharing an entity with it, as
+    # Annotations.add_annotation does
+    merge_cand = ann
+    for eq_ann in equivs[:]:
+        if any(ent in eq_ann.entities for ent in merge_cand.entities):
+            for m_ent in merge_cand.entities:
+                if m_ent not in eq_ann.entities:
+                    eq_ann.entities.append(m_ent)
+            if merge_cand is not ann:
+                equivs.remove(merge_cand)
+            merge_cand = eq_ann
+    if merge_cand is ann:
+        equivs.append(ann)
+
+def iter_annotations(document, kinds=None, text=False, merge_equivs=False):
+    '''
+    Iterate over the annotations of the given document as they are read,
+    without storing them or checking them against each other as
+    Annotations does, for consumers that only scan annotations.
+
+    Argument(s):
+    document - the document, as given to Annotations
+    kinds - the kinds of annotation lines to parse, by id prefix: 'T'
+        (text-bound), 'E' (event), 'R' (relation), 'A' (attribute), 'M'
+        (modifier), '#' (comment) and '*' (equiv). Other lines are skipped
+        without being parsed. All kinds if None.
+    text - verify text-bound annotations against the document text and
+        give access to it, as TextAnnotations does
+    merge_equivs - merge equivs sharing entities as Annotations does,
+        which means that equivs are only yielded after all other
+        annotations
+
+    Lines that can not be parsed are skipped, duplicate ids are only
+    detected within the kinds asked for.
+    '''
+    if text:
+        reader = _TextAnnotationsReader(document)
+    else:
+        reader = _AnnotationsReader(document)
+
+    equivs = []
+    for ann, failed in reader._iter_parsed_lines(kinds):
+        if failed:
+            continue
+        if isinstance(ann, EquivAnnotation):
+            if merge_equivs:
+                _merge_equiv(equivs, ann)
+                continue
+        else:
+            reader._ann_by_id[ann.id] = True
+        yield ann
+    for ann in equivs:
+        yield ann
+
+# Read-only annotation objects by (class, document), least recently used
+# first, along with the stamp of the files they were read from and the
+# messages reading them gave
+_ANNOTATIONS_CACHE = OrderedDict()
+_ANNOTATIONS_CACHE_LOCK = allocate_lock()
+
+def _document_files_stamp(document):
+    # (mtime, size, inode) of every file that can make up the document, or
+    # None for those that do not exist as they may appear later on
+    base, ext = splitext(document)
+    if ext[1:] not in KNOWN_FILE_SUFF:
+        base = document
+    return tuple(_file_stamp(path) for path in [document] + [base + '.' + suff
+            for suff in KNOWN_FILE_SUFF + [JOURNAL_FILE_SUFF,
+                TEXT_FILE_SUFFIX]])
+
+def _open_cached(annotations_class, document, cache=True):
+    key = (annotations_class, document)
+    stamp = _document_files_stamp(document)
+    with _ANNOTATIONS_CACHE_LOCK:
+        try:
+            cached = _ANNOTATIONS_CACHE.pop(key)
+        except KeyError:
+            pass
+        else:
+            cached_stamp, ann_obj, messages = cached
+            if cached_stamp == stamp:
+                # Re-insert to mark it as the most recently used
+                _ANNOTATIONS_CACHE[key] = cached
+                # Problems with the files are reported every time
+                Messager.add_messages(messages)
+                return ann_obj
+
+    message_count = Messager.pending_count()
+    ann_obj = annotations_class(document, read_only=True)
+    messages = Messager.messages_since(message_count)
+
+    # Documents that failed to parse are not cached so that the errors are
+    # reported every time they are opened
+    if cache and ANNOTATION_CACHE_SIZE > 0 and not ann_obj.failed_lines:
+        with _ANNOTATIONS_CACHE_LOCK:
+            _ANNOTATIONS_CACHE[key] = (stamp, ann_obj, messages)
+            while len(_ANNOTATIONS_CACHE) > ANNOTATION_CACHE_SIZE:
+                _ANNOTATIONS_CACHE.popitem(last=False)
+    return ann_obj
+
+def _invalidate_cached_annotations(document):
+    with _ANNOTATIONS_CACHE_LOCK:
+        for annotations_class in (Annotations, TextAnnotations):
+            _ANNOTATIONS_CACHE.pop((annotations_class, document), None)
+
+# Number of annotation writes by this process by directory
+_WRITE_COUNT_BY_DIR = {}
+
+def _count_write(document):
+    directory = dirname(abspath(document))
+    with _ANNOTATIONS_CACHE_LOCK:
+        _WRITE_COUNT_BY_DIR[directory] = _WRITE_COUNT_BY_DIR.get(
+                directory, 0) + 1
+
+def get_write_count(directory):
+    '''
+    Return the number of times this process has written annotations of
+    documents in the given directory. Appending to a journal does not
+    change the modification time of the directory, caches of what is in
+    the directory can use this to notice such writes.
+    '''
+    with _ANNOTATIONS_CACHE_LOCK:
+        return _WRITE_COUNT_BY_DIR.get(abspath(directory), 0)
+
+def compact_annotation_journal(document):
+    '''
+    Fold the journal of the given document, if any, back into its
+    annotation file and remove it. Returns True if there was a journal.
+    '''
+    with Annotations(document) as ann_obj:
+        if (ann_obj._journal_path is None
+                or _file_stamp(ann_obj._journal_path) is None):
+            return False
+        ann_obj._modified = True
+        ann_obj._rewrite = True
+    return True
+
+def open_cached_annotations(document, cache=True):
+    '''
+    Return a read-only Annotations object for the given document, re-using
+    the one parsed by an earlier call for as long as the files of the
+    document are unchanged (same modification time, size and inode).
+
+    The object is shared with other callers: adding, deleting and
+    updating annotations raises AnnotationsIsReadOnlyError, and the
+    annotations themselves must not be changed in place. If cache is
+    False an object that has to be parsed is not kept, for callers going
+    through many documents that would otherwise evict those in use.
+    '''
+    return _open_cached(Annotations, document, cache)
+
+def open_cached_text_annotations(document, cache=True):
+    '''
+    As open_cached_annotations, but returns a read-only TextAnnotations.
+    '''
+    return _open_cached(TextAnnotations, document, cache)
+
 class Annotation(object):
     """
     Base class for all annotations.
     """
+    # Documents can hold a great many annotations, avoid a __dict__ each
+    __slots__ = ('tail', 'source_id')
+
     def __init__(self, tail, source_id=None):
         self.tail = tail
         self.source_id = source_id
@@ -1011,6 +1808,8 @@ class UnknownAnnotation(Annotation):
     Represents a line of annotation that could not be parsed.
     These are not discarded, but rather passed through unmodified.
     """
+    __slots__ = ()
+
     def __init__(self, line, source_id=None):
         Annotation.__init__(self, line, source_id=source_id)
 
@@ -1026,6 +1825,8 @@ class UnparsedIdedAnnotation(Annotation):
     """
     # duck-type instead of inheriting from IdedAnnotation as
     # that inherits from TypedAnnotation and we have no type
+    __slots__ = ('id', )
+
     def __init__(self, id, line, source_id=None):
         # (this actually is the whole line, not just the id tail,
         # although Annotation will assign it to self.tail)
@@ -1039,6 +1840,8 @@ class TypedAnnotation(Annotation):
     """
     Base class for all annotations with a type.
     """
+    __slots__ = ('type', )
+
     def __init__(self, type, tail, source_id=None):
         Annotation.__init__(self, tail, source_id=source_id)
         self.type = type
@@ -1050,6 +1853,8 @@ class IdedAnnotation(TypedAnnotation):
     """
     Base class for all annotations with an ID.
     """
+    __slots__ = ('id', )
+
     def __init__(self, id, type, tail, source_id=None):
         TypedAnnotation.__init__(self, type, tail, source_id=source_id)
         self.id = id
@@ -1090,6 +1895,8 @@ class EventAnnotation(IdedAnnotation):
 
     ID\tTYPE:TRIGGER [ROLE1:PART1 ROLE2:PART2 ...]
     """
+    __slots__ = ('trigger', 'args')
+
     def __init__(self, trigger, args, id, type, tail, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.trigger = trigger
@@ -1162,6 +1969,8 @@ class EquivAnnotation(TypedAnnotation):
 
     Where "*" is the literal asterisk character.
     """
+    __slots__ = ('entities', )
+
     def __init__(self, type, entities, tail, source_id=None):
         TypedAnnotation.__init__(self, type, tail, source_id=source_id)
         self.entities = entities
@@ -1196,6 +2005,8 @@ class EquivAnnotation(TypedAnnotation):
         return '('+','.join([unicode(e) for e in self.entities])+')'
 
 class AttributeAnnotation(IdedAnnotation):
+    __slots__ = ('target', 'value')
+
     def __init__(self, target, id, type, tail, value, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.target = target
@@ -1222,6 +2033,8 @@ class AttributeAnnotation(IdedAnnotation):
         return [self.target]
 
 class OnelineCommentAnnotation(IdedAnnotation):
+    __slots__ = ('target', )
+
     def __init__(self, target, id, type, tail, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.target = target
@@ -1255,6 +2068,8 @@ class TextBoundAnnotation(IdedAnnotation):
     span of the annotation in text.
     """
 
+    __slots__ = ('start', 'end')
+
     def __init__(self, start, end, id, type, tail, source_id=None):
         # Note: if present, the text goes into tail
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
@@ -1290,6 +2105,8 @@ class TextBoundAnnotationWithText(TextBoundAnnotation):
     Where START and END are positive integer offsets identifying the
     span of the annotation in text and TEXT is the corresponding text.
     """
+    __slots__ = ('text', 'text_tail')
+
     def __init__(self, start, end, id, type, text, text_tail="", source_id=None):
         IdedAnnotation.__init__(self, id, type, '\t'+text+text_tail, source_id=source_id)
         self.start = start
@@ -1325,6 +2142,8 @@ class BinaryRelationAnnotation(IdedAnnotation):
 
     Where ARG1 and ARG2 are arbitrary (but not identical) labels.
     """
+    __slots__ = ('arg1l', 'arg1', 'arg2l', 'arg2')
+
     def __init__(self, id, type, arg1l, arg1, arg2l, arg2, tail, source_id=None):
         IdedAnnotation.__init__(self, id, type, tail, source_id=source_id)
         self.arg1l = arg1l
@@ -1349,6 +2168,96 @@ class BinaryRelationAnnotation(IdedAnnotation):
         hard_deps.add(self.arg2)
         return soft_deps, hard_deps
 
+# Annotation categories that Annotations keeps separate indexes for
+_INDEXED_CATEGORIES = (TextBoundAnnotation, EventAnnotation,
+        BinaryRelationAnnotation, AttributeAnnotation, EquivAnnotation,
+        OnelineCommentAnnotation)
+
+def _ann_category(ann):
+    for category in _INDEXED_CATEGORIES:
+        if isinstance(ann, category):
+            return category
+    return None
+
 if __name__ == '__main__':
-    #TODO: Unit-testing
-    pass
+    from os.path import isfile
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    # Changes made in place without update_annotation must not be lost
+    # when the other changes are appended to the journal
+    ANNOTATION_JOURNAL = True
+    test_dir = mkdtemp()
+    try:
+        document = path_join(test_dir, 'test')
+        with open_textfile(document + '.' + TEXT_FILE_SUFFIX, 'w') as txt_file:
+            txt_file.write(u'Foo binds bar\n')
+
+        def _write_test_document():
+            with open_textfile(document + '.' + JOINED_ANN_FILE_SUFF,
+                    'w') as ann_file:
+                ann_file.write(u'T1\tProtein 0 3\tFoo\n'
+                        u'T2\tProtein 10 13\tbar\n'
+                        u'T3\tBinding 4 9\tbinds\n'
+                        u'E1\tBinding:T3 Theme:T1\n')
+
+        def _test_edit(edit):
+            _write_test_document()
+            with TextAnnotations(document) as ann_obj:
+                edit(ann_obj)
+            ann_obj = TextAnnotations(document, read_only=True)
+            return dict((unicode(ann.id), unicode(ann).rstrip(u'\n'))
+                    for ann in ann_obj if hasattr(ann, 'id'))
+
+        def _registered_and_in_place(ann_obj):
+            ann_obj.del_annotation(ann_obj.get_ann_by_id(u'E1'))
+            ann_obj.get_ann_by_id(u'T2').type = u'Gene'
+
+        def _in_place(ann_obj):
+            ann_obj.get_ann_by_id(u'T2').type = u'Gene'
+
+        def _registered(ann_obj):
+            textbound = ann_obj.get_ann_by_id(u'T1')
+            textbound.type = u'Gene'
+            ann_obj.update_annotation(textbound)
+
+        anns = _test_edit(_registered_and_in_place)
+        assert u'E1' not in anns, anns
+        assert anns[u'T2'] == u'T2\tGene 10 13\tbar', anns
+
+        anns = _test_edit(_in_place)
+        assert anns[u'T2'] == u'T2\tGene 10 13\tbar', anns
+
+        # Registered changes alone still go to the journal
+        anns = _test_edit(_registered)
+        assert anns[u'T1'] == u'T1\tGene 0 3\tFoo', anns
+        assert isfile(_journal_path(document + '.' + JOINED_ANN_FILE_SUFF))
+
+        # get_triggers yields the trigger of every event, even if shared
+        _write_test_document()
+        with open_textfile(document + '.' + JOINED_ANN_FILE_SUFF,
+                'a') as ann_file:
+            ann_file.write(u'E2\tBinding:T3 Theme:T2\n')
+        ann_obj = TextAnnotations(document, read_only=True)
+        assert [t.id for t in ann_obj.get_triggers()] == [u'T3', u'T3']
+        assert ann_obj.get_trigger_ids() == set([u'T3'])
+
+        # Documents served from the cache repeat the messages of reading
+        # them
+        cached_document = path_join(test_dir, 'cached')
+        with open_textfile(cached_document + '.' + TEXT_FILE_SUFFIX,
+                'w') as txt_file:
+            txt_file.write(u'Foo\n')
+        with open_textfile(cached_document + '.' + JOINED_ANN_FILE_SUFF,
+                'w') as ann_file:
+            ann_file.write(u'T1\tProtein 0 3\n')
+        ANNOTATION_CACHE_SIZE = 1
+        Messager.output_json({})
+        first = open_cached_text_annotations(cached_document)
+        first_messages = Messager.output_json({})['messages']
+        assert first is open_cached_text_annotations(cached_document)
+        assert Messager.output_json({})['messages'] == first_messages
+        assert len(first_messages) == 1, first_messages
+    finally:
+        rmtree(test_dir)
+    print 'Succesful!'
@@ -15,11 +15,13 @@ from __future__ import with_statement
 
 from os.path import join as path_join
 from os.path import split as path_split
+from itertools import chain
 
 from annotation import (OnelineCommentAnnotation, TEXT_FILE_SUFFIX,
         TextAnnotations, DependingAnnotationDeleteError, TextBoundAnnotation,
         EventAnnotation, EquivAnnotation, open_textfile,
-        AnnotationsIsReadOnlyError, AttributeAnnotation)
+        AnnotationsIsReadOnlyError, AttributeAnnotation,
+        AnnotationNotFoundError)
 try:
     from config import DEBUG
 except ImportError:
@@ -134,6 +136,15 @@ class ModificationTracker(object):
     def change(self, before, after):
         self.__changed.append((before, after))
 
+    def ids(self):
+        # The ids of the annotations added, changed or deleted, in order
+        for ann in chain(self.__added, (a for _, a in self.__changed),
+                self.__deleted):
+            try:
+                yield ann.id
+            except AttributeError:
+                pass # not all annotations have ids
+
     def json_response(self, response=None):
         if response is None:
             response = {}
@@ -219,6 +230,58 @@ def _json_from_ann(ann_obj):
     _enrich_json_with_data(j_dic, ann_obj)
     return j_dic
 
+def _json_delta_from_ann(ann_obj, mods):
+    # Returns json with only the annotations added or changed by the
+    # modifications in mods and the ids of those deleted, for clients
+    # that patch the document data they already hold instead of
+    # replacing it. The records are in their current state and filed
+    # under the same keys as in the full document data, and the
+    # text-bounds that became or stopped being triggers are sent again
+    # to move them between the entities and triggers. Equivs and
+    # comments have no ids to patch by and are always sent in full, and
+    # lines that could not be parsed are left out as in the full data.
+    from document import (_enrich_json_with_base, _json_record,
+            _verification_comments)
+    j_dic = {}
+    _enrich_json_with_base(j_dic)
+    j_dic['deleted'] = []
+
+    trigger_ids = ann_obj.get_trigger_ids()
+    seen = set()
+    for id in chain(mods.ids(), ann_obj.get_reclassified_ids()):
+        if id in seen:
+            continue
+        seen.add(id)
+
+        try:
+            ann = ann_obj.get_ann_by_id(id)
+        except AnnotationNotFoundError:
+            j_dic['deleted'].append(id)
+            continue
+        key, record = _json_record(ann, trigger_ids)
+        if key is not None and key != 'comments':
+            j_dic[key].append(record)
+
+    for ann in chain(ann_obj.get_equivs(), ann_obj.get_oneline_comments()):
+        key, record = _json_record(ann, trigger_ids)
+        j_dic[key].append(record)
+    j_dic['comments'].extend(_verification_comments(ann_obj))
+
+    j_dic['mtime'] = ann_obj.ann_mtime
+    j_dic['ctime'] = ann_obj.ann_ctime
+    return j_dic
+
+def _attach_annotations(mods_json, ann_obj, mods, delta):
+    # Save the client a round-trip by attaching the annotation data to
+    # the response to an edit; in full under "annotations", or only what
+    # changed under "delta" if the client asked for it by passing
+    # delta=true (see _json_delta_from_ann)
+    if delta == 'true':
+        mods_json['delta'] = _json_delta_from_ann(ann_obj, mods)
+    else:
+        mods_json['annotations'] = _json_from_ann(ann_obj)
+    return mods_json
+
 from logging import info as log_info
 from annotation import TextBoundAnnotation, TextBoundAnnotationWithText
 from copy import deepcopy
@@ -268,6 +331,7 @@ def _edit_span(ann_obj, mods, id, start, end, projectconf, attributes, type,
             tb_ann.start = int(start)
             tb_ann.end = int(end)
             tb_ann.text = ann_obj._document_text[tb_ann.start:tb_ann.end]
+            ann_obj.update_annotation(tb_ann)
             #log_info('Span altered')
             mods.change(before, tb_ann)
 
@@ -282,6 +346,7 @@ def _edit_span(ann_obj, mods, id, start, end, projectconf, attributes, type,
         else:
             before = unicode(ann)
             ann.type = type
+            ann_obj.update_annotation(ann)
 
             # Try to propagate the type change
             try:
@@ -306,6 +371,7 @@ def _edit_span(ann_obj, mods, id, start, end, projectconf, attributes, type,
                         # Update the old annotation to use this trigger
                         ann.trigger = unicode(new_ann_trig.id)
                         ann_obj.add_annotation(new_ann_trig)
+                        ann_obj.update_annotation(ann)
                         mods.addition(new_ann_trig)
                     else:
                         # Okay, we own the current trigger, but does an
@@ -324,11 +390,13 @@ def _edit_span(ann_obj, mods, id, start, end, projectconf, attributes, type,
 
                             before = unicode(ann_trig)
                             ann_trig.type = ann.type
+                            ann_obj.update_annotation(ann_trig)
                             mods.change(before, ann_trig)
                         else:
                             # Attach the new trigger THEN delete
                             # or the dep will hit you
                             ann.trigger = unicode(found.id)
+                            ann_obj.update_annotation(ann)
                             ann_obj.del_annotation(ann_trig)
                             mods.deletion(ann_trig)
             except AttributeError:
@@ -413,6 +481,7 @@ def _set_attributes(ann_obj, ann, attributes, mods, undo_resp={}):
             if existing_attr_ann.value != new_value:
                 before = unicode(existing_attr_ann)
                 existing_attr_ann.value = new_value
+                ann_obj.update_annotation(existing_attr_ann)
                 mods.change(before, existing_attr_ann)
 
     # The remaining annotations are new and should be created
@@ -425,13 +494,13 @@ def _set_attributes(ann_obj, ann, attributes, mods, undo_resp={}):
 
 # To unshadow Python internals like "type" and "id"
 def create_span(collection, document, start, end, type, attributes=None,
-        id=None, comment=None):
+        id=None, comment=None, delta='false'):
     return _create_span(collection, document, start, end, type, attributes,
-            id, comment)
+            id, comment, delta)
 
 #TODO: ONLY determine what action to take! Delegate to Annotations!
 def _create_span(collection, document, start, end, _type, attributes=None,
-        _id=None, comment=None):
+        _id=None, comment=None, delta='false'):
     directory = collection
     undo_resp = {}
 
@@ -533,6 +602,7 @@ def _create_span(collection, document, start, end, _type, attributes=None,
                         # XXX: Note the ugly tab, it is for parsing the tail
                         before = unicode(found)
                         found.tail = u'\t' + comment
+                        ann_obj.update_annotation(found)
                         mods.change(before, found)
                     else:
                         # Create a new comment
@@ -557,15 +627,14 @@ def _create_span(collection, document, start, end, _type, attributes=None,
 
         if undo_resp:
             mods_json['undo'] = json_dumps(undo_resp)
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _attach_annotations(mods_json, ann_obj, mods, delta)
 
 from annotation import BinaryRelationAnnotation
 
 #TODO: Should determine which step to call next
 #def save_arc(directory, document, origin, target, type, old_type=None):
 def create_arc(collection, document, origin, target, type,
-        old_type=None, old_target=None):
+        old_type=None, old_target=None, delta='false'):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -621,6 +690,7 @@ def create_arc(collection, document, origin, target, type,
                     before = unicode(found)
                     found.arg2 = target.id
                     found.type = type
+                    ann_obj.update_annotation(found)
                     mods.change(before, found)
             else:
                 # Create a new annotation
@@ -642,6 +712,7 @@ def create_arc(collection, document, origin, target, type,
                     if arg_tup not in origin.args:
                         before = unicode(origin)
                         origin.add_argument(type, unicode(target.id))
+                        ann_obj.update_annotation(origin)
                         mods.change(before, origin)
                     else:
                         # It already existed as an arg, we were called to do nothing...
@@ -655,6 +726,7 @@ def create_arc(collection, document, origin, target, type,
                         before = unicode(origin)
                         origin.args.remove(old_arg_tup)
                         origin.add_argument(type, unicode(target.id))
+                        ann_obj.update_annotation(origin)
                         mods.change(before, origin)
                     else:
                         # Collision etc. don't do anything
@@ -674,11 +746,10 @@ def create_arc(collection, document, origin, target, type,
                 mods.addition(ann)
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _attach_annotations(mods_json, ann_obj, mods, delta)
 
 #TODO: ONLY determine what action to take! Delegate to Annotations!
-def delete_arc(collection, document, origin, target, type):
+def delete_arc(collection, document, origin, target, type, delta='false'):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -702,6 +773,7 @@ def delete_arc(collection, document, origin, target, type):
             if arg_tup in event_ann.args:
                 before = unicode(event_ann)
                 event_ann.args.remove(arg_tup)
+                ann_obj.update_annotation(event_ann)
                 mods.change(before, event_ann)
 
                 '''
@@ -733,6 +805,7 @@ def delete_arc(collection, document, origin, target, type):
                         before = unicode(eq_ann)
                         eq_ann.entities.remove(unicode(origin))
                         eq_ann.entities.remove(unicode(target))
+                        ann_obj.update_annotation(eq_ann)
                         mods.change(before, eq_ann)
 
                     if len(eq_ann.entities) < 2:
@@ -756,11 +829,10 @@ def delete_arc(collection, document, origin, target, type):
                 assert False, 'unknown annotation'
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _attach_annotations(mods_json, ann_obj, mods, delta)
 
 #TODO: ONLY determine what action to take! Delegate to Annotations!
-def delete_span(collection, document, id):
+def delete_span(collection, document, id, delta='false'):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -798,8 +870,7 @@ def delete_span(collection, document, id):
                     }
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _attach_annotations(mods_json, ann_obj, mods, delta)
 
 from common import ProtocolError
 
@@ -815,7 +886,7 @@ class AnnotationSplitError(ProtocolError):
         Messager.error(self.message)
         return json_dic
 
-def split_span(collection, document, args, id):
+def split_span(collection, document, args, id, delta='false'):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -877,13 +948,17 @@ def split_span(collection, document, args, id):
         for i, arg_combo in enumerate(argument_combos):
             # tweak args
             if i == 0:
+                before = unicode(ann)
                 ann.args = nonsplit_args[:] + arg_combo
+                ann_obj.update_annotation(ann)
+                mods.change(before, ann)
             else:
                 newann = deepcopy(ann)
                 newann.id = ann_obj.get_new_id("E") # TODO: avoid hard-coding ID prefix
                 newann.args = nonsplit_args[:] + arg_combo
                 ann_obj.add_annotation(newann)
                 new_events.append(newann)
+                mods.addition(newann)
 
         # then, go through all the annotations referencing the original
         # event, and create appropriate copies
@@ -895,12 +970,15 @@ def split_span(collection, document, args, id):
 
                 if isinstance(a, EventAnnotation):
                     # go through args and make copies for referencing
+                    before = unicode(a)
                     new_args = []
                     for arg, aid in a.args:
                         if aid == ann.id:
                             for newe in new_events:
                                 new_args.append((arg, newe.id))
                     a.args.extend(new_args)
+                    ann_obj.update_annotation(a)
+                    mods.change(before, a)
 
                 elif isinstance(a, AttributeAnnotation):
                     for newe in new_events:
@@ -908,6 +986,7 @@ def split_span(collection, document, args, id):
                         newmod.target = newe.id
                         newmod.id = ann_obj.get_new_id("A") # TODO: avoid hard-coding ID prefix
                         ann_obj.add_annotation(newmod)
+                        mods.addition(newmod)
 
                 elif isinstance(a, BinaryRelationAnnotation):
                     # TODO
@@ -919,12 +998,12 @@ def split_span(collection, document, args, id):
                         newcomm.target = newe.id
                         newcomm.id = ann_obj.get_new_id("#") # TODO: avoid hard-coding ID prefix
                         ann_obj.add_annotation(newcomm)
+                        mods.addition(newcomm)
                 else:
                     raise AnnotationSplitError("Cannot adjust annotation referencing split: not implemented for %s! (Please complain to the lazy developers to fix this!)" % a.__class__)
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _attach_annotations(mods_json, ann_obj, mods, delta)
 
 def set_status(directory, document, status=None):
     real_dir = real_directory(directory) 
@@ -80,3 +80,56 @@ def relpath(path, start):
     if not rel_list:
         return path
     return path_join(*rel_list)
+
+# os.scandir is not available in the Python versions we support, this
+# provides what we need of it: the listing of a directory and the status
+# of its entries in a single pass that callers can share
+def directory_entries(directory):
+    '''
+    Return the entries of the given directory as (name, stat) pairs in
+    listing order, where stat is the result of os.stat for the entry, or
+    None if the entry could not be stat'ed (e.g. a broken symbolic link
+    or an entry removed since the directory was listed).
+
+    Raises OSError if the directory itself cannot be listed.
+    '''
+    from os import listdir, stat
+    from os.path import join as path_join
+    entries = []
+    for name in listdir(directory):
+        try:
+            entry_stat = stat(path_join(directory, name))
+        except OSError:
+            entry_stat = None
+        entries.append((name, entry_stat))
+    return entries
+
+def is_hidden(file_name):
+    '''
+    Return True if the given directory entry is hidden from collection
+    listings.
+    '''
+    return file_name.startswith('hidden_') or file_name.startswith('.')
+
+def collection_document_names(directory):
+    '''
+    Return the names of the documents of the collection in the given
+    directory, as listed for it without access control.
+    '''
+    from os import listdir
+    return [fn[0:-4] for fn in listdir(directory)
+            if fn.endswith('txt') and not is_hidden(fn)]
+
+def collection_directories(directory, recursive=False):
+    '''
+    Yield the given directory and, if recursive, the directories of the
+    collections under it that are not hidden from listings, in order.
+    '''
+    from os import walk
+    from os.path import join as path_join
+    yield directory
+    if recursive:
+        for dirpath, dirnames, _ in walk(directory):
+            dirnames[:] = sorted(d for d in dirnames if not is_hidden(d))
+            for dirname in dirnames:
+                yield path_join(dirpath, dirname)
@@ -28,6 +28,7 @@ from jsonwrap import dumps
 from logging import info as log_info
 from annlog import log_annotation
 from message import Messager
+from projectconfig import refresh_config_caches
 from svg import store_svg, retrieve_stored
 from session import get_session, load_conf, save_conf
 from search import search_text, search_entity, search_event, search_relation
@@ -102,6 +103,12 @@ ANNOTATION_ACTION = set((
         'undo',
         ))
 
+# Request arguments passed to action function arguments of another name,
+# such as those that would shadow builtins
+HTTP_ARG_BY_ACTION_ARG = {
+        'name_filter': 'filter',
+        }
+
 # Actions that will be logged as annotator actions (if so configured)
 LOGGED_ANNOTATOR_ACTION = ANNOTATION_ACTION | set((
         'getDocument',
@@ -219,6 +226,9 @@ def dispatch(http_args, client_ip, client_hostname):
         log_info('Invalid action "%s"' % action)
         raise InvalidActionError(action)
 
+    # Pick up any configuration changes made since the last request
+    refresh_config_caches()
+
     # Determine what arguments the action function expects
     args, varargs, keywords, defaults = getargspec(action_function)
     # We will not allow this for now, there is most likely no need for it
@@ -236,14 +246,15 @@ def dispatch(http_args, client_ip, client_hostname):
 
     action_args = []
     for arg_name in args:
-        arg_val = http_args[arg_name]
+        http_arg_name = HTTP_ARG_BY_ACTION_ARG.get(arg_name, arg_name)
+        arg_val = http_args[http_arg_name]
 
         # The client failed to provide this argument
         if arg_val is None:
             try:
                 arg_val = default_val_by_arg[arg_name]
             except KeyError:
-                raise InvalidActionArgsError(action, arg_name)
+                raise InvalidActionArgsError(action, http_arg_name)
 
         action_args.append(arg_val)
 
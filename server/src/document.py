@@ -14,27 +14,40 @@ Author:     Pontus Stenetorp    <pontus is s u-tokyo ac jp>
 Version:    2011-04-21
 '''
 
-from os import listdir
-from os.path import abspath, isabs, isdir, normpath, getmtime
+from os import makedirs, stat, rename, remove, fdopen
+from os.path import abspath, dirname, isabs, isdir, normpath, getmtime
 from os.path import join as path_join
 from re import match,sub
-from errno import ENOENT, EACCES
-
-from annotation import (TextAnnotations, TEXT_FILE_SUFFIX,
+from errno import ENOENT, EACCES, EEXIST
+from tempfile import mkstemp
+from array import array
+from stat import S_ISDIR
+from cPickle import dump as pickle_dump, load as pickle_load, HIGHEST_PROTOCOL
+from collections import OrderedDict
+from logging import warning as log_warning
+from thread import allocate_lock
+from time import time
+
+from annotation import (open_cached_text_annotations, TEXT_FILE_SUFFIX,
         AnnotationFileNotFoundError, 
         AnnotationCollectionNotFoundError,
-        JOINED_ANN_FILE_SUFF,
-        open_textfile)
-from common import ProtocolError, CollectionNotAccessibleError
-from config import DATA_DIR
+        JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF,
+        EventAnnotation, BinaryRelationAnnotation, TextBoundAnnotation,
+        EquivAnnotation, AttributeAnnotation, OnelineCommentAnnotation,
+        UnknownAnnotation, UnparsedIdedAnnotation, open_textfile,
+        get_write_count)
+from common import (ProtocolError, CollectionNotAccessibleError,
+        directory_entries, is_hidden)
+from config import DATA_DIR, WORK_DIR
 from projectconfig import (ProjectConfiguration, SEPARATOR_STR, 
         SPAN_DRAWING_ATTRIBUTES, ARC_DRAWING_ATTRIBUTES,
         VISUAL_SPAN_DEFAULT, VISUAL_ARC_DEFAULT, 
         ATTR_DRAWING_ATTRIBUTES, VISUAL_ATTR_DEFAULT,
         ENTITY_NESTING_TYPE)
-from stats import get_statistics
+from stats import get_statistics, get_sorted_statistics
 from message import Messager
 from auth import allowed_to_read, AccessDeniedError
+from session import get_session
 from annlog import annotation_logging_active
 
 try:
@@ -52,7 +65,26 @@ try:
 except ImportError:
     NER_TAGGING_SERVICES = []
 
-from itertools import chain
+from itertools import chain, izip
+
+# Sub-directory of WORK_DIR holding the sentence and token offsets cached
+# by _get_text_offsets; bump the version when the segmentation or the
+# format of the entries changes
+TEXT_OFFSETS_CACHE_DIR = 'offsets'
+TEXT_OFFSETS_CACHE_VERSION = 2
+
+# Number of sorted and filtered collection listings kept for the following
+# pages, and for how many seconds they are used if the directory does not
+# change, see _sorted_listing
+LISTING_CACHE_SIZE = 16
+LISTING_CACHE_SECONDS = 10
+
+# Listing by (directory, user, sort, sort_order, name_filter), least
+# recently used first, along with when it was made and the modification
+# time of the directory and the annotation write count (see
+# annotation.get_write_count) at the time
+_LISTING_CACHE = OrderedDict()
+_LISTING_CACHE_LOCK = allocate_lock()
 
 def _fill_type_configuration(nodes, project_conf, hotkey_by_type):
     items = []
@@ -135,11 +167,7 @@ def _fill_type_configuration(nodes, project_conf, hotkey_by_type):
                 if project_conf.is_relation_type(_type):
                     targets = []
                 else:
-                    targets = []
-                    # TODO: should include this functionality in projectconf
-                    for ttype in project_conf.get_entity_types() + project_conf.get_event_types():
-                        if arc in project_conf.arc_types_from_to(_type, ttype):
-                            targets.append(ttype)
+                    targets = project_conf.arc_target_types(_type, arc)
                 curr_arc['targets'] = targets
 
                 arcs.append(curr_arc)
@@ -399,18 +427,25 @@ def relative_directory(directory):
     assert directory.startswith(DATA_DIR), 'directory "%s" not under DATA_DIR'
     return directory[len(DATA_DIR):]
 
-def _is_hidden(file_name):
-    return file_name.startswith('hidden_') or file_name.startswith('.')
+def _is_dir_stat(entry_stat):
+    return entry_stat is not None and S_ISDIR(entry_stat.st_mode)
 
-def _listdir(directory):
-    #return listdir(directory)
+def _directory_entries(directory):
+    # directory_entries, failing as a listing of a missing collection
     try:
-        assert_allowed_to_read(directory)
-        return [f for f in listdir(directory) if not _is_hidden(f)
-                and allowed_to_read(path_join(directory, f))]
+        return directory_entries(directory)
     except OSError, e:
         Messager.error("Error listing %s: %s" % (directory, e))
         raise AnnotationCollectionNotFoundError(directory)
+
+def _listdir(directory, entries=None):
+    # entries are the (name, stat) pairs of the directory as returned by
+    # directory_entries, listed here if not given
+    assert_allowed_to_read(directory)
+    if entries is None:
+        entries = _directory_entries(directory)
+    return [f for f, f_stat in entries if not is_hidden(f)
+            and allowed_to_read(path_join(directory, f), _is_dir_stat(f_stat))]
     
 def _getmtime(file_path):
     '''
@@ -433,41 +468,163 @@ def _getmtime(file_path):
             # We are unable to handle this exception, pass it one
             raise
 
+def _get_ann_mtime(doc_path):
+    '''
+    Internal function returning the time the annotations of a document were
+    last modified, which may only have reached the journal of its
+    annotation file (see ANNOTATION_JOURNAL).
+
+    Arguments:
+
+    doc_path - path to the document, without suffix
+    '''
+
+    return max(_getmtime(doc_path + '.' + JOINED_ANN_FILE_SUFF),
+            _getmtime(doc_path + '.' + JOURNAL_FILE_SUFF))
+
+def _get_ann_mtime_from_stats(docname, stat_by_name):
+    # As _get_ann_mtime, for a document in a directory whose entries were
+    # already stat'ed (see directory_entries)
+    mtime = -1
+    for suff in (JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF):
+        file_stat = stat_by_name.get(docname + '.' + suff)
+        if file_stat is not None:
+            mtime = max(mtime, file_stat.st_mtime)
+    return mtime
+
+def _make_sorted_listing(real_dir, sort, sort_order, name_filter):
+    entries = _directory_entries(real_dir)
+    stat_by_name = dict(entries)
+    names = _listdir(real_dir, entries)
+    base_names = [fn[0:-4] for fn in names if fn.endswith('txt')]
+
+    try:
+        stats_types, docnames, stats_by_docname = get_sorted_statistics(
+                real_dir, base_names, sort,
+                descending=(sort_order == 'descending'),
+                stat_by_name=stat_by_name)
+    except ValueError:
+        raise InvalidListingArgumentError('sort', sort)
+
+    if name_filter:
+        name_filter = name_filter.lower()
+        docnames = [docname for docname in docnames
+                if name_filter in docname.lower()]
+    return stat_by_name, names, stats_types, docnames, stats_by_docname
+
+def _sorted_listing(real_dir, sort, sort_order, name_filter):
+    # The status of the entries of the directory by name, the names the
+    # user may read, the stat types, the names of the documents sorted
+    # and filtered as requested and their statistics by name. The first
+    # page lists and sorts the whole collection, the listing is then
+    # re-used for the following pages so that paging through a large
+    # collection does not do so for every page. Writes by this process
+    # and changes to the directory are seen right away, but edits that
+    # other server processes only append to annotation journals do not
+    # change the directory and show up after at most
+    # LISTING_CACHE_SECONDS.
+    try:
+        user = get_session().get('user')
+    except KeyError:
+        user = None
+    key = (real_dir, user, sort, sort_order, name_filter)
+    dir_mtime = _getmtime(real_dir)
+    write_count = get_write_count(real_dir)
+
+    now = time()
+    with _LISTING_CACHE_LOCK:
+        cached = _LISTING_CACHE.pop(key, None)
+        if cached is not None:
+            made, made_dir_mtime, made_write_count, listing = cached
+            if (made_dir_mtime == dir_mtime
+                    and made_write_count == write_count
+                    and 0 <= now - made < LISTING_CACHE_SECONDS):
+                # Re-insert to mark it as the most recently used
+                _LISTING_CACHE[key] = cached
+                return listing
+
+    listing = _make_sorted_listing(real_dir, sort, sort_order, name_filter)
+    with _LISTING_CACHE_LOCK:
+        _LISTING_CACHE[key] = (now, dir_mtime, write_count, listing)
+        while len(_LISTING_CACHE) > LISTING_CACHE_SIZE:
+            _LISTING_CACHE.popitem(last=False)
+    return listing
+
+def _page_range(offset, limit, sort_order):
+    # The offset and limit of a page of a listing as integers, limit
+    # None for all documents from offset on
+    try:
+        offset = int(offset) if offset is not None else 0
+        if offset < 0:
+            raise ValueError
+    except ValueError:
+        raise InvalidListingArgumentError('offset', offset)
+    try:
+        limit = int(limit) if limit is not None else None
+        if limit is not None and limit < 0:
+            raise ValueError
+    except ValueError:
+        raise InvalidListingArgumentError('limit', limit)
+    if sort_order not in ('ascending', 'descending'):
+        raise InvalidListingArgumentError('sort_order', sort_order)
+    return offset, limit
+
 # TODO: This is not the prettiest of functions
-def get_directory_information(collection):
+def get_directory_information(collection, offset=None, limit=None,
+        sort=None, sort_order='ascending', name_filter=None):
+    # If any of offset, limit, sort and name_filter (the "filter" argument
+    # of the request) are given, only the page of limit documents starting
+    # at offset (default all from the first) is listed, sorted by the
+    # column named by sort (default "Document") in sort_order and
+    # restricted to the documents whose names contain name_filter
+    # (ignoring case). Collections are always listed in full, and total is
+    # the number of documents in all pages.
     directory = collection
 
     real_dir = real_directory(directory)
     
     assert_allowed_to_read(real_dir)
     
-    # Get the document names
-    base_names = [fn[0:-4] for fn in _listdir(real_dir)
-            if fn.endswith('txt')]
-
-    doclist = base_names[:]
-    doclist_header = [("Document", "string")]
-
-    # Then get the modification times
-    doclist_with_time = []
-    for file_name in doclist:
-        file_path = path_join(DATA_DIR, real_dir,
-            file_name + "." + JOINED_ANN_FILE_SUFF)
-        doclist_with_time.append([file_name, _getmtime(file_path)])
-    doclist = doclist_with_time
-    doclist_header.append(("Modified", "time"))
-
+    # List the directory once, the listing, the modification times and
+    # the statistics are all based on the status of its entries
     try:
-        stats_types, doc_stats = get_statistics(real_dir, base_names)
+        if (offset is None and limit is None and sort is None
+                and name_filter is None):
+            entries = _directory_entries(real_dir)
+            stat_by_name = dict(entries)
+            names = _listdir(real_dir, entries)
+
+            # Get the document names
+            base_names = [fn[0:-4] for fn in names if fn.endswith('txt')]
+
+            stats_types, doc_stats = get_statistics(real_dir, base_names,
+                    stat_by_name=stat_by_name)
+            doc_total = len(base_names)
+        else:
+            offset, limit = _page_range(offset, limit, sort_order)
+            (stat_by_name, names, stats_types, docnames, stats_by_docname
+                    ) = _sorted_listing(real_dir, sort or 'Document',
+                            sort_order, name_filter)
+            if limit is None:
+                base_names = docnames[offset:]
+            else:
+                base_names = docnames[offset:offset + limit]
+            doc_stats = [stats_by_docname[docname] for docname in base_names]
+            doc_total = len(docnames)
     except OSError:
         # something like missing access permissions?
         raise CollectionNotAccessibleError
-                
-    doclist = [doclist[i] + doc_stats[i] for i in range(len(doclist))]
+
+    doclist_header = [("Document", "string"), ("Modified", "time")]
     doclist_header += stats_types
 
-    dirlist = [dir for dir in _listdir(real_dir)
-            if isdir(path_join(real_dir, dir))]
+    # Then add the modification times and the statistics
+    doclist = []
+    for file_name, docstats in izip(base_names, doc_stats):
+        doclist.append([file_name,
+            _get_ann_mtime_from_stats(file_name, stat_by_name)] + docstats)
+
+    dirlist = [dir for dir in names if _is_dir_stat(stat_by_name[dir])]
     # just in case, and for generality
     dirlist = [[dir] for dir in dirlist]
 
@@ -515,6 +672,7 @@ def get_directory_information(collection):
 
     json_dic = {
             'items': combolist,
+            'total': doc_total,
             'header' : doclist_header,
             'parent': parent,
             'messages': [],
@@ -544,6 +702,19 @@ class UnableToReadTextFile(ProtocolError):
         json_dic['exception'] = 'unableToReadTextFile'
         return json_dic
 
+class InvalidListingArgumentError(ProtocolError):
+    def __init__(self, argument, value):
+        self.argument = argument
+        self.value = value
+
+    def __str__(self):
+        return 'Invalid value "%s" for collection listing argument "%s"' % (
+                self.value, self.argument)
+
+    def json(self, json_dic):
+        json_dic['exception'] = 'invalidListingArgument'
+        return json_dic
+
 class IsDirectoryError(ProtocolError):
     def __init__(self, path):
         self.path = path
@@ -555,6 +726,141 @@ class IsDirectoryError(ProtocolError):
         json_dic['exception'] = 'isDirectoryError'
         return json_dic
 
+def _segment_text(text):
+    if JAPANESE:
+        from ssplit import jp_sentence_boundary_gen
+        from tokenise import jp_token_boundary_gen
+
+        sentence_offsets = [o for o in jp_sentence_boundary_gen(text)]
+        token_offsets = [o for o in jp_token_boundary_gen(text)]
+    else:
+        from ssplit import en_sentence_boundary_gen
+        from tokenise import en_token_boundary_gen
+
+        sentence_offsets = [o for o in en_sentence_boundary_gen(text)]
+        token_offsets = [o for o in en_token_boundary_gen(text)]
+    return sentence_offsets, token_offsets
+
+def _text_offsets_cache_path(txt_file_path):
+    from hashlib import sha1
+
+    return path_join(WORK_DIR, TEXT_OFFSETS_CACHE_DIR,
+            sha1(txt_file_path).hexdigest())
+
+def _offsets_from_array(flat):
+    return zip(flat[::2], flat[1::2])
+
+def _get_text_offsets(txt_file_path, text):
+    # Sentence and token offsets for the text of txt_file_path, cached in
+    # WORK_DIR by the version of the text file and the tokenisation
+    # configuration so that a text is only segmented once per version
+    from tokenise import TOKENIZATION
+
+    try:
+        txt_stat = stat(txt_file_path)
+    except OSError:
+        return _segment_text(text)
+
+    # the length guards against text read before a change to the file
+    key = (TEXT_OFFSETS_CACHE_VERSION, JAPANESE, TOKENIZATION,
+            txt_stat.st_mtime, txt_stat.st_size, len(text))
+    if isinstance(txt_file_path, unicode):
+        txt_file_path = txt_file_path.encode('utf-8')
+    txt_file_path = abspath(txt_file_path)
+    cache_path = _text_offsets_cache_path(txt_file_path)
+    try:
+        # An entry is the key and the text file path, which is all that
+        # prune_text_offsets_cache reads, followed by the offsets
+        with open(cache_path, 'rb') as cache_file:
+            cached_key, _ = pickle_load(cache_file)
+            if cached_key == key:
+                sentence_flat, token_flat = pickle_load(cache_file)
+                return (_offsets_from_array(sentence_flat),
+                        _offsets_from_array(token_flat))
+    except IOError, e:
+        if e.errno != ENOENT:
+            log_warning('unable to read offsets cache %s: %s' % (
+                cache_path, e))
+    except Exception:
+        # Corrupt or written by an incompatible version, just replace it
+        pass
+
+    sentence_offsets, token_offsets = _segment_text(text)
+
+    try:
+        cache_dir = dirname(cache_path)
+        if not isdir(cache_dir):
+            try:
+                makedirs(cache_dir)
+            except OSError, e:
+                if e.errno != EEXIST:
+                    raise
+        # Write to a temporary file and rename it into place so that a
+        # concurrent reader never sees a partial cache
+        tmp_fd, tmp_path = mkstemp(dir=cache_dir)
+        try:
+            with fdopen(tmp_fd, 'wb') as tmp_file:
+                pickle_dump((key, txt_file_path), tmp_file,
+                        HIGHEST_PROTOCOL)
+                pickle_dump((array('l', chain.from_iterable(sentence_offsets)),
+                    array('l', chain.from_iterable(token_offsets))),
+                    tmp_file, HIGHEST_PROTOCOL)
+            rename(tmp_path, cache_path)
+        except:
+            remove(tmp_path)
+            raise
+    except (IOError, OSError), e:
+        log_warning('unable to write offsets cache %s: %s' % (cache_path, e))
+
+    return sentence_offsets, token_offsets
+
+def prune_text_offsets_cache():
+    '''
+    Remove the entries of the offsets cache of _get_text_offsets for text
+    files that no longer exist, such as those of deleted or renamed
+    documents, and entries of other versions. Returns the number of
+    entries removed.
+    '''
+    from os import listdir
+    from os.path import isfile
+
+    cache_dir = path_join(WORK_DIR, TEXT_OFFSETS_CACHE_DIR)
+    try:
+        entry_names = listdir(cache_dir)
+    except OSError, e:
+        if e.errno == ENOENT:
+            return 0
+        raise
+
+    removed = 0
+    for entry_name in entry_names:
+        if entry_name.startswith('tmp'):
+            # Being written by _get_text_offsets
+            continue
+        cache_path = path_join(cache_dir, entry_name)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                cached_key, txt_file_path = pickle_load(cache_file)
+            stale = (cached_key[0] != TEXT_OFFSETS_CACHE_VERSION
+                    or not isfile(txt_file_path))
+        except IOError, e:
+            if e.errno == ENOENT:
+                # Already removed
+                continue
+            raise
+        except Exception:
+            # Corrupt or written by an incompatible version
+            stale = True
+
+        if stale:
+            try:
+                remove(cache_path)
+                removed += 1
+            except OSError, e:
+                if e.errno != ENOENT:
+                    raise
+    return removed
+
 #TODO: All this enrichment isn't a good idea, at some point we need an object
 def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
     if raw_text is not None:
@@ -580,74 +886,70 @@ def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
     text = text.replace("  ", ' '+unichr(0x00A0))
 
     j_dic['text'] = text
-    
-    from logging import info as log_info
 
-    if JAPANESE:
-        from ssplit import jp_sentence_boundary_gen
-        from tokenise import jp_token_boundary_gen
-
-        sentence_offsets = [o for o in jp_sentence_boundary_gen(text)]
-        #log_info('offsets: ' + str(offsets))
-        j_dic['sentence_offsets'] = sentence_offsets
-
-        token_offsets = [o for o in jp_token_boundary_gen(text)]
-        j_dic['token_offsets'] = token_offsets
-    else:
-        from ssplit import en_sentence_boundary_gen
-        from tokenise import en_token_boundary_gen
-
-        sentence_offsets = [o for o in en_sentence_boundary_gen(text)]
-        #log_info('offsets: ' + str(sentence_offsets))
-        j_dic['sentence_offsets'] = sentence_offsets
-        
-        token_offsets = [o for o in en_token_boundary_gen(text)]
-        j_dic['token_offsets'] = token_offsets
+    sentence_offsets, token_offsets = _get_text_offsets(txt_file_path, text)
+    j_dic['sentence_offsets'] = sentence_offsets
+    j_dic['token_offsets'] = token_offsets
 
     return True
 
-def _enrich_json_with_data(j_dic, ann_obj):
-    # We collect trigger ids to be able to link the textbound later on
-    trigger_ids = set()
-    for event_ann in ann_obj.get_events():
-        trigger_ids.add(event_ann.trigger)
-        j_dic['events'].append(
-                [unicode(event_ann.id), unicode(event_ann.trigger), event_ann.args]
-                )
-
-    for rel_ann in ann_obj.get_relations():
-        j_dic['relations'].append(
-            [unicode(rel_ann.id), unicode(rel_ann.type), rel_ann.arg1, rel_ann.arg2]
-            )
-
-    for tb_ann in ann_obj.get_textbounds():
-        j_tb = [unicode(tb_ann.id), tb_ann.type, tb_ann.start, tb_ann.end]
-
-        # If we spotted it in the previous pass as a trigger for an
-        # event or if the type is known to be an event type, we add it
-        # as a json trigger.
+def _json_record(ann, trigger_ids):
+    # The key of the json document data list that ann belongs to and the
+    # record for it in that list, (None, None) for the lines that could
+    # not be parsed which are reported as errors instead
+    if isinstance(ann, EventAnnotation):
+        return 'events', [unicode(ann.id), unicode(ann.trigger), ann.args]
+    elif isinstance(ann, BinaryRelationAnnotation):
+        return 'relations', [unicode(ann.id), unicode(ann.type), ann.arg1,
+                ann.arg2]
+    elif isinstance(ann, TextBoundAnnotation):
+        # If it is a trigger for an event we add it as a json trigger.
         # TODO: proper handling of disconnected triggers. Currently
         # these will be erroneously passed as 'entities'
-        if unicode(tb_ann.id) in trigger_ids:
-            j_dic['triggers'].append(j_tb)
-        else: 
-            j_dic['entities'].append(j_tb)
-
-    for eq_ann in ann_obj.get_equivs():
-        j_dic['equivs'].append(
-                (['*', eq_ann.type]
-                    + [e for e in eq_ann.entities])
-                )
+        if unicode(ann.id) in trigger_ids:
+            key = 'triggers'
+        else:
+            key = 'entities'
+        return key, [unicode(ann.id), ann.type, ann.start, ann.end]
+    elif isinstance(ann, EquivAnnotation):
+        return 'equivs', ['*', ann.type] + [e for e in ann.entities]
+    elif isinstance(ann, AttributeAnnotation):
+        return 'attributes', [unicode(ann.id), ann.type, ann.target,
+                ann.value]
+    elif isinstance(ann, OnelineCommentAnnotation):
+        return 'comments', [ann.target, ann.type, ann.tail.strip()]
+    elif isinstance(ann, (UnknownAnnotation, UnparsedIdedAnnotation)):
+        return None, None
+    assert False, 'no json record for %s' % (ann, )
+
+def _verification_comments(ann_obj):
+    # The issues found by verify_annotation as json comments, if enabled
+    try:
+        if PERFORM_VERIFICATION:
+            # XXX avoid digging the directory from the ann_obj
+            import os
+            docdir = os.path.dirname(ann_obj._document)
+            from verify_annotations import (verify_annotation,
+                    compiled_configuration)
+            issues = verify_annotation(ann_obj,
+                    compiled_configuration(docdir))
+        else:
+            issues = []
+    except Exception, e:
+        # TODO add an issue about the failure?
+        issues = []
+        Messager.error('Error: verify_annotation() failed: %s' % e, -1)
 
-    for att_ann in ann_obj.get_attributes():
-        j_dic['attributes'].append(
-                [unicode(att_ann.id), att_ann.type, att_ann.target, att_ann.value]
-                )
+    return [(unicode(i.ann_id), i.type, i.description) for i in issues]
 
-    for com_ann in ann_obj.get_oneline_comments():
-        j_dic['comments'].append(
-                [com_ann.target, com_ann.type, com_ann.tail.strip()]
-                )
+def _enrich_json_with_data(j_dic, ann_obj):
+    # Trigger ids to be able to link the textbound later on
+    trigger_ids = ann_obj.get_trigger_ids()
+    for ann in chain(ann_obj.get_events(), ann_obj.get_relations(),
+            ann_obj.get_textbounds(), ann_obj.get_equivs(),
+            ann_obj.get_attributes(), ann_obj.get_oneline_comments()):
+        key, record = _json_record(ann, trigger_ids)
+        j_dic[key].append(record)
 
     if ann_obj.failed_lines:
         error_msg = 'Unable to parse the following line(s):\n%s' % (
@@ -664,23 +966,7 @@ def _enrich_json_with_data(j_dic, ann_obj):
     j_dic['mtime'] = ann_obj.ann_mtime
     j_dic['ctime'] = ann_obj.ann_ctime
 
-    try:
-        if PERFORM_VERIFICATION:
-            # XXX avoid digging the directory from the ann_obj
-            import os
-            docdir = os.path.dirname(ann_obj._document)
-            projectconf = ProjectConfiguration(docdir)
-            from verify_annotations import verify_annotation
-            issues = verify_annotation(ann_obj, projectconf)
-        else:
-            issues = []
-    except Exception, e:
-        # TODO add an issue about the failure?
-        issues = []
-        Messager.error('Error: verify_annotation() failed: %s' % e, -1)
-
-    for i in issues:
-        j_dic['comments'].append((unicode(i.ann_id), i.type, i.description))
+    j_dic['comments'].extend(_verification_comments(ann_obj))
 
     # Attach the source files for the annotations and text
     from os.path import splitext
@@ -704,6 +990,44 @@ def _enrich_json_with_base(j_dic):
     j_dic['equivs'] = []
     j_dic['comments'] = []
 
+def _merge_sentences_within_spans(s_breaks, spans):
+    '''
+    Internal function merging each sentence whose end lies within one of
+    the given (start, end) spans with the sentence following it, returns
+    the resulting list of sentence offsets.
+
+    Arguments:
+
+    s_breaks - list of (start, end) sentence offsets
+    spans - iterable of (start, end) spans, normally text-bound annotations
+    '''
+
+    # XXX: The merge strategy can lead to unforeseen consequences if two
+    #   sentences are not adjacent (the format allows for this:
+    #   S_1: [0, 10], S_2: [15, 20])
+    # Sweep over the sentence ends in order, keeping track of the furthest
+    #   end of the spans starting before them; a span streches over a
+    #   sentence end if it starts before it and ends after it
+    spans = sorted(spans)
+    within = [False] * len(s_breaks)
+    span_i = 0
+    max_span_end = None
+    for s_end, s_i in sorted((s_end, s_i)
+            for s_i, (_, s_end) in enumerate(s_breaks)):
+        while span_i < len(spans) and spans[span_i][0] < s_end:
+            max_span_end = max(max_span_end, spans[span_i][1])
+            span_i += 1
+        within[s_i] = max_span_end is not None and max_span_end > s_end
+
+    merged = []
+    for s_i, s_break in enumerate(s_breaks):
+        if merged and within[s_i - 1]:
+            # Merge the previous sentence and this sentence
+            merged[-1] = (merged[-1][0], s_break[1])
+        else:
+            merged.append(s_break)
+    return merged
+
 def _document_json_dict(document):
     #TODO: DOC!
 
@@ -718,26 +1042,14 @@ def _document_json_dict(document):
     # Read in the textual data to make it ready to push
     _enrich_json_with_text(j_dic, document + '.' + TEXT_FILE_SUFFIX)
 
-    with TextAnnotations(document) as ann_obj:
+    with open_cached_text_annotations(document) as ann_obj:
         # Note: At this stage the sentence offsets can conflict with the
         #   annotations, we thus merge any sentence offsets that lie within
         #   annotations
-        # XXX: ~O(tb_ann * sentence_breaks), can be optimised
-        # XXX: The merge strategy can lead to unforeseen consequences if two
-        #   sentences are not adjacent (the format allows for this:
-        #   S_1: [0, 10], S_2: [15, 20])
-        s_breaks = j_dic['sentence_offsets']
-        for tb_ann in ann_obj.get_textbounds():
-            s_i = 0
-            while s_i < len(s_breaks):
-                s_start, s_end = s_breaks[s_i]
-                # Does the annotation strech over the end of the sentence?
-                if tb_ann.start < s_end and tb_ann.end > s_end:
-                    # Merge this sentence and the next sentence
-                    s_breaks[s_i] = (s_start, s_breaks[s_i + 1][1])
-                    del s_breaks[s_i + 1]
-                else:
-                    s_i += 1
+        j_dic['sentence_offsets'] = _merge_sentences_within_spans(
+                j_dic['sentence_offsets'],
+                ((tb_ann.start, tb_ann.end)
+                    for tb_ann in ann_obj.get_textbounds()))
         
         _enrich_json_with_data(j_dic, ann_obj)
 
@@ -754,9 +1066,84 @@ def get_document_timestamp(collection, document):
     real_dir = real_directory(directory)
     assert_allowed_to_read(real_dir)
     doc_path = path_join(real_dir, document)
-    ann_path = doc_path + '.' + JOINED_ANN_FILE_SUFF
-    mtime = _getmtime(ann_path)
+    mtime = _get_ann_mtime(doc_path)
 
     return {
             'mtime': mtime,
             }
+
+if __name__ == '__main__':
+    from unittest import TestCase
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from glob import glob
+    from os.path import dirname, isfile
+    import tarfile
+
+    from annotation import TextAnnotations, KNOWN_FILE_SUFF
+    from ssplit import en_sentence_boundary_gen
+
+    def _merge_sentences_within_spans_by_rescanning(s_breaks, spans):
+        # The original algorithm, ~O(spans * sentence_breaks)
+        s_breaks = list(s_breaks)
+        for start, end in spans:
+            s_i = 0
+            while s_i < len(s_breaks):
+                s_start, s_end = s_breaks[s_i]
+                # Does the annotation strech over the end of the sentence?
+                if start < s_end and end > s_end:
+                    # Merge this sentence and the next sentence
+                    s_breaks[s_i] = (s_start, s_breaks[s_i + 1][1])
+                    del s_breaks[s_i + 1]
+                else:
+                    s_i += 1
+        return s_breaks
+
+    class SentenceMergeTest(TestCase):
+        def test_merges(self):
+            s_breaks = [(0, 10), (11, 20), (21, 30), (31, 40)]
+            self.assertEqual(_merge_sentences_within_spans(s_breaks,
+                [(8, 12), (5, 9), (19, 25)]), [(0, 30), (31, 40)])
+            self.assertEqual(_merge_sentences_within_spans(s_breaks,
+                [(0, 10), (11, 20)]), s_breaks)
+            self.assertEqual(_merge_sentences_within_spans(s_breaks, []),
+                    s_breaks)
+            self.assertEqual(_merge_sentences_within_spans([], [(0, 1)]),
+                    [])
+
+        def test_example_data(self):
+            # Same result as the original algorithm on the example data
+            data_dir = mkdtemp()
+            try:
+                for archive_path in glob(path_join(dirname(__file__),
+                        '../../example-data/*.tar.gz')):
+                    archive = tarfile.open(archive_path)
+                    try:
+                        archive.extractall(data_dir)
+                    finally:
+                        archive.close()
+
+                documents = 0
+                for txt_path in glob(path_join(data_dir, '*', '*.txt')):
+                    doc_path = txt_path[:-len('.txt')]
+                    if not any(isfile(doc_path + '.' + suff)
+                            for suff in KNOWN_FILE_SUFF):
+                        continue
+                    with open_textfile(txt_path, 'r') as txt_file:
+                        s_breaks = list(en_sentence_boundary_gen(
+                            txt_file.read()))
+                    spans = [(tb_ann.start, tb_ann.end) for tb_ann
+                            in TextAnnotations(doc_path,
+                                read_only=True).get_textbounds()]
+                    self.assertEqual(
+                            _merge_sentences_within_spans(s_breaks, spans),
+                            _merge_sentences_within_spans_by_rescanning(
+                                s_breaks, spans),
+                            'different sentences for %s' % doc_path)
+                    documents += 1
+                self.assertTrue(documents, 'no example data found')
+            finally:
+                rmtree(data_dir)
+
+    import unittest
+    unittest.main()
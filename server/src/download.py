@@ -7,12 +7,14 @@ Version:    2011-10-03
 
 from __future__ import with_statement
 
-from os import remove
-from os.path import join as path_join, dirname, basename
+from logging import warning as log_warning
+from os import remove, walk
+from os.path import join as path_join, dirname, basename, isfile
 from tempfile import mkstemp
 
 from document import real_directory
-from annotation import open_textfile
+from annotation import (open_textfile, open_cached_annotations,
+        compact_annotation_journal, JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF)
 from common import NoPrintJSONError
 from subprocess import Popen
 
@@ -30,16 +32,42 @@ def download_file(document, collection, extension):
     hdrs = [('Content-Type', 'text/plain; charset=utf-8'),
             ('Content-Disposition',
                 'inline; filename=%s' % fname)]
-    with open_textfile(fpath, 'r') as txt_file:
-        data = txt_file.read().encode('utf-8')
+    if (extension == JOINED_ANN_FILE_SUFF and isfile(path_join(real_dir,
+            '%s.%s' % (document, JOURNAL_FILE_SUFF)))):
+        # The annotation file lacks the edits that are still in its
+        # journal, serve the annotations as read with the journal
+        with open_cached_annotations(path_join(real_dir, document)
+                ) as ann_obj:
+            data = unicode(ann_obj).encode('utf-8')
+    else:
+        with open_textfile(fpath, 'r') as txt_file:
+            data = txt_file.read().encode('utf-8')
     raise NoPrintJSONError(hdrs, data)
 
+def _compact_journals(real_dir):
+    # Fold the annotation journals under real_dir into their annotation
+    # files, which are otherwise archived without the journaled edits
+    journal_suff = '.' + JOURNAL_FILE_SUFF
+    for root, _, fnames in walk(real_dir):
+        for fname in fnames:
+            if not fname.endswith(journal_suff):
+                continue
+            document = path_join(root, fname[:-len(journal_suff)])
+            try:
+                compact_annotation_journal(document)
+            except Exception, e:
+                # The journal is archived too and replayed once imported
+                log_warning('unable to compact the journal of "%s": %s' % (
+                    document, e))
+
 def download_collection(collection):
     directory = collection
     real_dir = real_directory(directory)
     dir_name = basename(dirname(real_dir))
     fname = '%s.%s' % (dir_name, 'tar.gz')
 
+    _compact_journals(real_dir)
+
     tmp_file_path = None
     try:
         _, tmp_file_path = mkstemp()
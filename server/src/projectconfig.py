@@ -18,6 +18,10 @@ import robotparser # TODO reduce scope
 import urlparse # TODO reduce scope
 import sys
 
+from itertools import chain
+from os import stat
+from time import time
+
 from annotation import open_textfile
 from message import Messager
 
@@ -488,7 +492,9 @@ def __parse_access_control(acstr, source):
 def get_config_path(directory):
     return __read_first_in_directory_tree(directory, __annotation_config_filename)[1]
 
-def __read_first_in_directory_tree(directory, filename):
+def __directory_tree_paths(directory, filename):
+    # Paths of the given file in the directory and its parents, nearest
+    # first, but not above BASE_DIR
     # config will not be available command-line invocations;
     # in these cases search whole tree
     try:
@@ -497,20 +503,53 @@ def __read_first_in_directory_tree(directory, filename):
         BASE_DIR = "/"
     from os.path import split, join
 
-    source, result = None, None
-
-    # check from the given directory and parents, but not above BASE_DIR
     if directory is not None:
         # TODO: this check may fail; consider "foo//bar/data"
         while BASE_DIR in directory:
-            source = join(directory, filename)
-            result = __read_or_default(source, None)
-            if result is not None:
+            yield join(directory, filename)
+            parent = split(directory)[0]
+            if parent == directory:
                 break
-            directory = split(directory)[0]
+            directory = parent
+
+def __read_first_in_directory_tree(directory, filename):
+    source, result = None, None
+
+    # check from the given directory and parents, but not above BASE_DIR
+    for source in __directory_tree_paths(directory, filename):
+        result = __read_or_default(source, None)
+        if result is not None:
+            break
 
     return (result, source)
 
+def __config_files_stamp(directory, filename):
+    # Stamp of all the files that reading the given configuration file
+    # for the directory may consult: those in the directory tree and the
+    # default in the working directory; missing files are stamped too
+    # so that adding one is noticed
+    stamp = []
+    for path in chain(__directory_tree_paths(directory, filename),
+            (filename, )):
+        try:
+            st = stat(path)
+            stamp.append((path, st.st_mtime, st.st_size, st.st_ino))
+        except OSError:
+            stamp.append((path, None))
+    return tuple(stamp)
+
+# Stamps of the configuration files read, by (directory, file name); see
+# refresh_config_caches()
+__config_files_stamp_by_key = {}
+# Seconds between checks of the stamps by refresh_config_caches()
+CONFIG_CHECK_INTERVAL = 2
+
+def __record_config_files(directory, filename):
+    # Take the stamp before reading, so that a change made while reading
+    # is caught on the next refresh
+    __config_files_stamp_by_key[(directory, filename)] = (
+            __config_files_stamp(directory, filename))
+
 def __parse_configs(configstr, source, expected_sections, optional_sections):
     # top-level config structure is a set of term hierarchies
     # separated by lines consisting of "[SECTION]" where SECTION is
@@ -551,6 +590,7 @@ def __parse_configs(configstr, source, expected_sections, optional_sections):
             
 def get_configs(directory, filename, defaultstr, minconf, sections, optional_sections):
     if (directory, filename) not in get_configs.__cache:
+        __record_config_files(directory, filename)
         configstr, source =  __read_first_in_directory_tree(directory, filename)
 
         if configstr is None:
@@ -720,6 +760,7 @@ def get_disambiguator_config(directory):
 def get_access_control(directory):
     cache = get_access_control.__cache
     if directory not in cache:
+        __record_config_files(directory, __access_control_filename)
         a = __get_access_control(directory,
                          __access_control_filename,
                          __default_access_control)
@@ -731,6 +772,7 @@ get_access_control.__cache = {}
 def get_kb_shortcuts(directory):
     cache = get_kb_shortcuts.__cache
     if directory not in cache:
+        __record_config_files(directory, __kb_shortcut_filename)
         a = __get_kb_shortcuts(directory,
                                 __kb_shortcut_filename,
                                 __default_kb_shortcuts,
@@ -931,6 +973,106 @@ def get_labels_by_storage_form(directory, term):
     return cache[directory].get(term, None)
 get_labels_by_storage_form.__cache = {}
 
+class TypeTables(object):
+    """
+    Lookup tables for the types of the project configuration of a
+    directory, built once per configuration (see get_type_tables()).
+    The per-type tables are filled in on first use.
+    """
+
+    def __init__(self, directory):
+        self.entity_types = [t.storage_form()
+                for t in get_entity_type_list(directory)]
+        self.event_types = [t.storage_form()
+                for t in get_event_type_list(directory)]
+        self.relation_types = [t.storage_form()
+                for t in get_relation_type_list(directory)]
+        self.attribute_types = [t.storage_form()
+                for t in get_attribute_type_list(directory)]
+        # equivalence relations are those relations that are symmetric
+        # and transitive, i.e. that have "symmetric" and "transitive"
+        # in their "<REL-TYPE>" special argument values.
+        self.equiv_types = [t.storage_form()
+                for t in get_relation_type_list(directory)
+                if "<REL-TYPE>" in t.special_arguments and
+                "symmetric" in t.special_arguments["<REL-TYPE>"] and
+                "transitive" in t.special_arguments["<REL-TYPE>"]]
+
+        self.entity_type_set = frozenset(self.entity_types)
+        self.event_type_set = frozenset(self.event_types)
+        self.relation_type_set = frozenset(self.relation_types)
+        self.equiv_type_set = frozenset(self.equiv_types)
+
+        # type -> attribute types, (from, to, include_special) -> arc types,
+        # (from, arc) -> arc target types
+        self.attributes_by_type = {}
+        self.arc_types_by_from_to = {}
+        self.arc_targets_by_from_arc = {}
+
+def get_type_tables(directory):
+    cache = get_type_tables.__cache
+    if directory not in cache:
+        cache[directory] = TypeTables(directory)
+    return cache[directory]
+get_type_tables.__cache = {}
+
+# Caches of values read from or derived from the configuration files, by
+# directory
+__directory_caches = (
+    get_labels.__cache,
+    get_drawing_types.__cache,
+    get_access_control.__cache,
+    get_kb_shortcuts.__cache,
+    get_entity_type_list.__cache,
+    get_event_type_list.__cache,
+    get_relation_type_list.__cache,
+    get_attribute_type_list.__cache,
+    get_search_config_list.__cache,
+    get_annotator_config_list.__cache,
+    get_disambiguator_config_list.__cache,
+    get_node_by_storage_form.__cache,
+    get_drawing_config_by_storage_form.__cache,
+    get_relations_by_arg1.__cache,
+    get_relations_by_arg2.__cache,
+    get_labels_by_storage_form.__cache,
+    get_type_tables.__cache,
+    )
+
+def refresh_config_caches(force=False):
+    """
+    Drops everything cached for the directories for which any of the
+    configuration files consulted, including those in parent
+    directories, has been changed, added or removed since it was read.
+    Called by the server for each request so that long-running servers
+    pick up configuration changes; unless force is True the files are
+    only checked once every CONFIG_CHECK_INTERVAL seconds.
+    """
+    now = time()
+    last_check = refresh_config_caches.__last_check
+    if (not force and last_check is not None
+            and 0 <= now - last_check < CONFIG_CHECK_INTERVAL):
+        return
+    refresh_config_caches.__last_check = now
+
+    stale = set()
+    for (directory, filename), stamp in __config_files_stamp_by_key.items():
+        if __config_files_stamp(directory, filename) != stamp:
+            stale.add(directory)
+
+    if not stale:
+        return
+
+    for key in __config_files_stamp_by_key.keys():
+        if key[0] in stale:
+            del __config_files_stamp_by_key[key]
+    for key in get_configs.__cache.keys():
+        if key[0] in stale:
+            del get_configs.__cache[key]
+    for cache in __directory_caches:
+        for directory in stale:
+            cache.pop(directory, None)
+refresh_config_caches.__last_check = None
+
 # fallback for missing or partial config: these are highly likely to
 # be entity (as opposed to an event or relation) types.
 # TODO: remove this workaround once the configs stabilize.
@@ -1065,13 +1207,67 @@ class ProjectConfiguration(object):
             Messager.warning("Project configuration: unknown textbound/event type %s. Configuration may be wrong." % from_ann)
             return []
 
+        table = get_type_tables(self.directory).arc_types_by_from_to
+        key = (from_ann, to_ann, include_special)
+        if key not in table:
+            table[key] = self.__arc_types_from_to(from_node, from_ann,
+                    to_ann, include_special)
+        return table[key][:]
+
+    def arc_target_types(self, from_ann, arc):
+        """
+        Returns the entity and event types, in this order, that an arc
+        of the given type can connect an annotation of type from_ann
+        to; that is, the types for which arc_types_from_to(from_ann,
+        type) includes arc.
+        """
+        from_node = get_node_by_storage_form(self.directory, from_ann)
+
+        if from_node is None:
+            Messager.warning("Project configuration: unknown textbound/event type %s. Configuration may be wrong." % from_ann)
+            return []
+
+        tables = get_type_tables(self.directory)
+        key = (from_ann, arc)
+        if key not in tables.arc_targets_by_from_arc:
+            tables.arc_targets_by_from_arc[key] = self.__arc_target_types(
+                    from_node, from_ann, arc, tables)
+        return tables.arc_targets_by_from_arc[key][:]
+
+    def __arc_target_types(self, from_node, from_ann, arc, tables):
+        # The inverse of __arc_types_from_to, computed from the argument
+        # and relation definitions instead of trying every type
+        all_types = tables.entity_types + tables.event_types
+
+        targets = set(t for t, keys in from_node.keys_by_type.items()
+                if arc in keys)
+        for r in get_relations_by_arg1(self.directory, from_ann):
+            if r.storage_form() == arc:
+                arg2_types = r.arguments[r.arg_list[1]]
+                # relations take <ENTITY> for any type, see
+                # __directory_relations_by_arg_num()
+                if "<ANY>" in arg2_types or "<ENTITY>" in arg2_types:
+                    return all_types
+                targets.update(arg2_types)
+
+        if "<ANY>" in targets:
+            return all_types
+
+        generic_event = "<EVENT>" in targets
+        generic_entity = "<ENTITY>" in targets
+        return [t for t in all_types if t in targets or
+                (generic_event and t in tables.event_type_set) or
+                (generic_entity and self.is_physical_entity_type(t))]
+
+    def __arc_types_from_to(self, from_node, from_ann, to_ann,
+            include_special):
         if to_ann == "<ANY>":
             relations_from = get_relations_by_arg1(self.directory, from_ann, include_special)
             # TODO: consider using from_node.arg_list instead of .arguments for order
             return unique_preserve_order([role for role in from_node.arguments] + [r.storage_form() for r in relations_from])
 
-        # specific hits
-        types = from_node.keys_by_type.get(to_ann, [])
+        # specific hits (copied, as the node's lists must not be extended)
+        types = list(from_node.keys_by_type.get(to_ann, []))
 
         if "<ANY>" in from_node.keys_by_type:
             types += from_node.keys_by_type["<ANY>"]
@@ -1092,6 +1288,12 @@ class ProjectConfiguration(object):
         Returs a list of the possible attribute types for an
         annotation of the given type.
         """
+        table = get_type_tables(self.directory).attributes_by_type
+        if ann_type not in table:
+            table[ann_type] = self.__attributes_for(ann_type)
+        return table[ann_type][:]
+
+    def __attributes_for(self, ann_type):
         attrs = []
         for attr in get_attribute_type_list(self.directory):
             if attr == SEPARATOR_STR:
@@ -1120,22 +1322,16 @@ class ProjectConfiguration(object):
         return get_access_control(self.directory)
 
     def get_attribute_types(self):
-        return [t.storage_form() for t in get_attribute_type_list(self.directory)]
+        return get_type_tables(self.directory).attribute_types[:]
 
     def get_event_types(self):
-        return [t.storage_form() for t in get_event_type_list(self.directory)]
+        return get_type_tables(self.directory).event_types[:]
 
     def get_relation_types(self):
-        return [t.storage_form() for t in get_relation_type_list(self.directory)]
+        return get_type_tables(self.directory).relation_types[:]
 
     def get_equiv_types(self):
-        # equivalence relations are those relations that are symmetric
-        # and transitive, i.e. that have "symmetric" and "transitive"
-        # in their "<REL-TYPE>" special argument values.
-        return [t.storage_form() for t in get_relation_type_list(self.directory)
-                if "<REL-TYPE>" in t.special_arguments and
-                "symmetric" in t.special_arguments["<REL-TYPE>"] and
-                "transitive" in t.special_arguments["<REL-TYPE>"]]
+        return get_type_tables(self.directory).equiv_types[:]
 
     def get_relation_by_type(self, _type):
         # TODO: dict storage
@@ -1192,7 +1388,7 @@ class ProjectConfiguration(object):
         return self._get_tool_config(tool_list)
 
     def get_entity_types(self):
-        return [t.storage_form() for t in get_entity_type_list(self.directory)]
+        return get_type_tables(self.directory).entity_types[:]
 
     def get_entity_type_hierarchy(self):
         return get_entity_type_hierarchy(self.directory)
@@ -1259,26 +1455,28 @@ class ProjectConfiguration(object):
             return labels[0]
 
     def is_physical_entity_type(self, t):
-        if t in self.get_entity_types() or t in self.get_event_types():
-            return t in self.get_entity_types()
+        tables = get_type_tables(self.directory)
+        if t in tables.entity_type_set or t in tables.event_type_set:
+            return t in tables.entity_type_set
         # TODO: remove this temporary hack
         if t in very_likely_physical_entity_types:
             return True
-        return t in self.get_entity_types()
+        return False
 
     def is_event_type(self, t):
-        return t in self.get_event_types()
+        return t in get_type_tables(self.directory).event_type_set
 
     def is_relation_type(self, t):
-        return t in self.get_relation_types()
+        return t in get_type_tables(self.directory).relation_type_set
 
     def is_equiv_type(self, t):
-        return t in self.get_equiv_types()
+        return t in get_type_tables(self.directory).equiv_type_set
 
     def is_configured_type(self, t):
-        return (t in self.get_entity_types() or
-                t in self.get_event_types() or
-                t in self.get_relation_types())
+        tables = get_type_tables(self.directory)
+        return (t in tables.entity_type_set or
+                t in tables.event_type_set or
+                t in tables.relation_type_set)
 
     def type_category(self, t):
         """
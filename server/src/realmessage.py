@@ -51,6 +51,21 @@ class Messager:
             print >> o, c, ":", m
     output = staticmethod(output)
 
+    # To repeat the messages of an operation whose result is re-used, take
+    # messages_since(pending_count()) from before it and pass them to
+    # add_messages when re-using the result
+    def pending_count():
+        return len(Messager.__pending_messages)
+    pending_count = staticmethod(pending_count)
+
+    def messages_since(count):
+        return tuple(Messager.__pending_messages[count:])
+    messages_since = staticmethod(messages_since)
+
+    def add_messages(messages):
+        Messager.__pending_messages.extend(messages)
+    add_messages = staticmethod(add_messages)
+
     def output_json(json_dict):
         try:
             return Messager.__output_json(json_dict)
@@ -8,6 +8,7 @@
 from __future__ import with_statement
 
 import re
+import sys
 import annotation
 
 from message import Messager
@@ -39,9 +40,10 @@ class SearchMatchSet(object):
     an ann an Annotation belonging to the corresponding ann_obj.
     """
 
-    def __init__(self, criterion, matches=[]):
+    def __init__(self, criterion, matches=None):
         self.criterion = criterion
-        self.__matches = matches
+        # not a default argument, that list would be shared by all sets
+        self.__matches = matches if matches is not None else []
 
     def add_match(self, ann_obj, ann):
         self.__matches.append((ann_obj, ann))
@@ -92,7 +94,10 @@ class TextMatch(object):
 
 def __filenames_to_annotations(filenames):
     """
-    Given file names, returns corresponding Annotations objects.
+    Given file names, generates corresponding Annotations objects.
+    Each file is only read once its object is requested, so that a
+    search that stops early (see MAX_SEARCH_RESULT_NUMBER) does not
+    read the remaining files.
     """
     
     # TODO: error output should be done via messager to allow
@@ -102,39 +107,48 @@ def __filenames_to_annotations(filenames):
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
 
-    anns = []
+    ann_count = 0
     for fn in filenames:
         try:
             # remove suffixes for Annotations to prompt parsing of .a1
             # also.
             nosuff_fn = fn.replace(".ann","").replace(".a2","").replace(".rel","")
-            ann_obj = annotation.TextAnnotations(nosuff_fn, read_only=True)
-            anns.append(ann_obj)
+            ann_obj = annotation.open_cached_text_annotations(nosuff_fn)
         except annotation.AnnotationFileNotFoundError:
             print >> sys.stderr, "%s:\tFailed: file not found" % fn
+            continue
         except annotation.AnnotationNotFoundError, e:
             print >> sys.stderr, "%s:\tFailed: %s" % (fn, e)
+            continue
+        ann_count += 1
+        yield ann_obj
 
-    if len(anns) != len(filenames):
-        print >> sys.stderr, "Note: only checking %d/%d given files" % (len(anns), len(filenames))
+    if ann_count != len(filenames):
+        print >> sys.stderr, "Note: only checking %d/%d given files" % (ann_count, len(filenames))
 
     if REPORT_SEARCH_TIMINGS:
         process_delta = datetime.now() - process_start
         print >> stderr, "filenames_to_annotations: processed in", str(process_delta.seconds)+"."+str(process_delta.microseconds/10000), "seconds"
 
-    return anns
-
-def __directory_to_annotations(directory):
+def __directory_to_annotations(directory, texts=(), types=()):
     """
     Given a directory, returns Annotations objects for contained files.
+    If given, texts and types are the search constraints (see
+    searchindex.filter_documents) that the search index is used to skip
+    the files without matches for.
     """
     # TODO: put this shared functionality in a more reasonable place
-    from document import real_directory,_listdir
+    from document import real_directory,_listdir,_directory_entries
+    from searchindex import filter_documents
     from os.path import join as path_join
 
     real_dir = real_directory(directory)
+    entries = _directory_entries(real_dir)
     # Get the document names
-    base_names = [fn[0:-4] for fn in _listdir(real_dir) if fn.endswith('txt')]
+    base_names = [fn[0:-4] for fn in _listdir(real_dir, entries)
+            if fn.endswith('txt')]
+    base_names = filter_documents(real_dir, base_names, texts, types,
+            stat_by_name=dict(entries))
 
     filenames = [path_join(real_dir, bn) for bn in base_names]
 
@@ -154,19 +168,22 @@ def __document_to_annotations(directory, document):
 
     return __filenames_to_annotations(filenames)
 
-def __doc_or_dir_to_annotations(directory, document, scope):
+def __doc_or_dir_to_annotations(directory, document, scope, texts=(),
+                                types=()):
     """
     Given a directory, a document, and a scope specification
     with the value "collection" or "document" selecting between
     the two, returns Annotations object for either the specific
     document identified (scope=="document") or all documents in
-    the given directory (scope=="collection").
+    the given directory (scope=="collection"), skipping those that
+    the search index shows to have no matches for the search
+    constraints texts and types.
     """
 
     # TODO: lots of magic values here; try to avoid this
 
     if scope == "collection":
-        return __directory_to_annotations(directory)
+        return __directory_to_annotations(directory, texts, types)
     elif scope == "document":
         # NOTE: "/NO-DOCUMENT/" is a workaround for a brat
         # client-server comm issue (issue #513).
@@ -486,6 +503,22 @@ def _get_match_regex(text, text_match="word", match_case=False,
         Messager.error('Unrecognized search match specification "%s"' % text_match)
         return None    
 
+def _add_matches(matches, ann_obj, anns):
+    """
+    Helper for the various search_anns_for_ functions. Adds the given
+    annotations (or other matches) in ann_obj to the SearchMatchSet
+    matches, taking them from anns one at a time. Returns False once
+    there is a match beyond MAX_SEARCH_RESULT_NUMBER, in which case
+    the search should stop without looking at further documents.
+    """
+    for ann in anns:
+        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
+        if len(matches) >= MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
+            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+            return False
+        matches.add_match(ann_obj, ann)
+    return True
+
 def search_anns_for_textbound(ann_objs, text, restrict_types=[], 
                               ignore_types=[], nested_types=[], 
                               text_match="word", match_case=False,
@@ -547,16 +580,9 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=[],
         ann_matches.sort(lambda a,b: cmp((a.start,-a.end),(b.start,-b.end)))
 
         # add to overall collection
-        for t in ann_matches:
-            matches.add_match(ann_obj, t)    
-
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        if not _add_matches(matches, ann_obj, ann_matches):
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
-
     # sort by document name for output
     matches.sort_matches()
 
@@ -665,16 +691,9 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
         #ann_matches.sort(lambda a,b: cmp(???))
 
         # add to overall collection
-        for r in ann_matches:
-            matches.add_match(ann_obj, r)
-
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        if not _add_matches(matches, ann_obj, ann_matches):
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
-
     # sort by document name for output
     matches.sort_matches()
 
@@ -794,16 +813,10 @@ def search_anns_for_event(ann_objs, trigger_text, args,
         ann_matches.sort(lambda a,b: cmp((a[0].start,-a[0].end),(b[0].start,-b[0].end)))
 
         # add to overall collection
-        for t_obj, e in ann_matches:
-            matches.add_match(ann_obj, e)
-
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        if not _add_matches(matches, ann_obj,
+                            [e for t_obj, e in ann_matches]):
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
-
     # sort by document name for output
     matches.sort_matches()
 
@@ -813,6 +826,42 @@ def search_anns_for_event(ann_objs, trigger_text, args,
 
     return matches
 
+def _text_matches(ann_obj, match_regex, restrict_types, ignore_types):
+    """
+    Helper for search_anns_for_text. Generates TextMatch objects for
+    the matches of match_regex in the document text of ann_obj that
+    satisfy the type restrictions.
+    """
+    doctext = ann_obj.get_document_text()
+
+    for m in match_regex.finditer(doctext):
+        # only need to care about embedding annotations if there's
+        # some annotation-based restriction
+        #if restrict_types == [] and ignore_types == []:
+        # TODO: _extremely_ naive and slow way to find embedding
+        # annotations.  Use some reasonable data structure
+        # instead.
+        embedding = []
+        # if there are no type restrictions, we can skip this bit
+        if restrict_types != [] or ignore_types != []:
+            for t in ann_obj.get_textbounds():
+                if t.start <= m.start() and t.end >= m.end():
+                    embedding.append(t)
+
+        # Note interpretation of ignore_types here: if the text
+        # span is embedded in one or more of the ignore_types or
+        # the ignore_types include the special value "ANY", the
+        # match is ignored.
+        if len([e for e in embedding if e.type in ignore_types or "ANY" in ignore_types]) != 0:
+            continue
+
+        if restrict_types != [] and len([e for e in embedding if e.type in restrict_types]) == 0:
+            continue
+
+        # TODO: need a clean, standard way of identifying a text span
+        # that does not involve an annotation; this is a bit of a hack
+        yield TextMatch(m.start(), m.end(), m.group())
+
 def search_anns_for_text(ann_objs, text, 
                          restrict_types=[], ignore_types=[], nested_types=[], 
                          text_match="word", match_case=False):
@@ -846,44 +895,13 @@ def search_anns_for_text(ann_objs, text,
 
     # main search loop
     for ann_obj in ann_objs:
-        doctext = ann_obj.get_document_text()
-
-        for m in match_regex.finditer(doctext):
-            # only need to care about embedding annotations if there's
-            # some annotation-based restriction
-            #if restrict_types == [] and ignore_types == []:
-            # TODO: _extremely_ naive and slow way to find embedding
-            # annotations.  Use some reasonable data structure
-            # instead.
-            embedding = []
-            # if there are no type restrictions, we can skip this bit
-            if restrict_types != [] or ignore_types != []:
-                for t in ann_obj.get_textbounds():
-                    if t.start <= m.start() and t.end >= m.end():
-                        embedding.append(t)
-
-            # Note interpretation of ignore_types here: if the text
-            # span is embedded in one or more of the ignore_types or
-            # the ignore_types include the special value "ANY", the
-            # match is ignored.
-            if len([e for e in embedding if e.type in ignore_types or "ANY" in ignore_types]) != 0:
-                continue
-
-            if restrict_types != [] and len([e for e in embedding if e.type in restrict_types]) == 0:
-                continue
-
-            # TODO: need a clean, standard way of identifying a text span
-            # that does not involve an annotation; this is a bit of a hack
-            tm = TextMatch(m.start(), m.end(), m.group())
-            matches.add_match(ann_obj, tm)
-
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
-            Messager.warning('Search result limit (%d) exceeded, stopping search.' % MAX_SEARCH_RESULT_NUMBER)
+        # matches are generated as they are added, so a search stopped
+        # at the result limit does not look at the rest of the text
+        if not _add_matches(matches, ann_obj,
+                            _text_matches(ann_obj, match_regex,
+                                          restrict_types, ignore_types)):
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
-
     if REPORT_SEARCH_TIMINGS:
         process_delta = datetime.now() - process_start
         print >> stderr, "search_anns_for_text: processed in", str(process_delta.seconds)+"."+str(process_delta.microseconds/10000), "seconds"
@@ -1074,7 +1092,8 @@ def search_text(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)    
+    ann_objs = __doc_or_dir_to_annotations(directory, document, scope,
+                                           texts=[(text, text_match)])
 
     matches = search_anns_for_text(ann_objs, text, 
                                    text_match=text_match, 
@@ -1096,7 +1115,9 @@ def search_entity(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
+    ann_objs = __doc_or_dir_to_annotations(directory, document, scope,
+                                           texts=[(text, text_match)],
+                                           types=[('entity', type)])
 
     restrict_types = []
     if type is not None and type != "":
@@ -1123,7 +1144,9 @@ def search_event(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
+    ann_objs = __doc_or_dir_to_annotations(directory, document, scope,
+                                           texts=[(trigger, text_match)],
+                                           types=[('event', type)])
 
     restrict_types = []
     if type is not None and type != "":
@@ -1157,7 +1180,10 @@ def search_relation(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
     
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
+    ann_objs = __doc_or_dir_to_annotations(directory, document, scope,
+                                           texts=[(arg1, text_match),
+                                                  (arg2, text_match)],
+                                           types=[('relation', type)])
 
     restrict_types = []
     if type is not None and type != "":
@@ -1197,7 +1223,8 @@ def check_files_consistency(filenames, restrict_types=[], ignore_types=[], neste
     """
     Searches for inconsistent annotations in the given set of files.
     """
-    anns = __filenames_to_annotations(filenames)
+    # the consistency checks go through the documents more than once
+    anns = list(__filenames_to_annotations(filenames))
     return check_consistency(anns, restrict_types=restrict_types, ignore_types=ignore_types, nested_types=nested_types)
 
 def argparser():
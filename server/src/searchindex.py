@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+from __future__ import with_statement
+
+'''
+Per-collection index of the terms and annotation types of documents, used
+to restrict collection search to the documents that can have matches.
+
+The index is an SQLite database in WORK_DIR holding, for each document,
+the terms of its text and text-bound annotations and the types of its
+entities, events and relations. Like the statistics cache it is brought
+up to date on use by comparing the modification times and sizes of the
+document files with those recorded when the document was indexed, so
+only changed documents are read again; tools/buildsearchindex.py builds
+the index ahead of the first search.
+'''
+
+from errno import EEXIST
+from hashlib import sha1
+from logging import info as log_info
+from logging import warning as log_warning
+from os import makedirs, remove
+from os.path import abspath, isdir
+from os.path import join as path_join
+import re
+
+try:
+    import sqlite3
+except ImportError:
+    # Python built without SQLite, search without an index
+    sqlite3 = None
+
+from annotation import (open_cached_text_annotations, KNOWN_FILE_SUFF,
+        TEXT_FILE_SUFFIX, JOURNAL_FILE_SUFF, AnnotationFileNotFoundError,
+        AnnotationNotFoundError)
+from common import directory_entries
+from config import WORK_DIR
+
+try:
+    from config import SEARCH_INDEX
+except ImportError:
+    SEARCH_INDEX = True
+
+### Constants
+# Sub-directory of WORK_DIR holding the indexes
+SEARCH_INDEX_DIR = 'search'
+# Bump when the terms or the schema change
+SEARCH_INDEX_VERSION = 1
+# Seconds to wait for another process updating the index
+SEARCH_INDEX_TIMEOUT = 30
+# Terms are what the search regular expressions (see
+# search._get_match_regex), compiled without re.UNICODE, consider words
+TERM_RE = re.compile(r'\w+')
+###
+
+SCHEMA = (
+        'CREATE TABLE meta (key TEXT PRIMARY KEY, value)',
+        # indexed is 0 for documents that could not be read, which are
+        # searched regardless of the index
+        'CREATE TABLE documents (id INTEGER PRIMARY KEY, '
+            'name TEXT UNIQUE NOT NULL, stamp TEXT NOT NULL, '
+            'indexed INTEGER NOT NULL)',
+        'CREATE TABLE terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE NOT NULL)',
+        'CREATE TABLE postings (term INTEGER NOT NULL, '
+            'document INTEGER NOT NULL, PRIMARY KEY (term, document))',
+        'CREATE INDEX postings_by_document ON postings (document)',
+        'CREATE TABLE types (kind TEXT NOT NULL, type TEXT NOT NULL, '
+            'document INTEGER NOT NULL, PRIMARY KEY (kind, type, document))',
+        'CREATE INDEX types_by_document ON types (document)',
+        )
+
+def _index_path(directory):
+    if isinstance(directory, unicode):
+        directory = directory.encode('utf-8')
+    return path_join(WORK_DIR, SEARCH_INDEX_DIR,
+            sha1(abspath(directory)).hexdigest() + '.sqlite')
+
+def _stored_name(docname):
+    # Document names are stored and read back as UTF-8 encoded strings
+    if isinstance(docname, unicode):
+        return docname.encode('utf-8')
+    return docname
+
+def _create_index(connection):
+    with connection:
+        for table in ('meta', 'documents', 'terms', 'postings', 'types'):
+            connection.execute('DROP TABLE IF EXISTS %s' % table)
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.execute('INSERT INTO meta VALUES (?, ?)',
+                ('version', SEARCH_INDEX_VERSION))
+
+def _connect(directory, rebuild=False):
+    # The index of the directory, created if missing or of another version
+    index_path = _index_path(directory)
+    index_dir = path_join(WORK_DIR, SEARCH_INDEX_DIR)
+    if not isdir(index_dir):
+        try:
+            makedirs(index_dir)
+        except OSError, e:
+            if e.errno != EEXIST:
+                raise
+
+    connection = sqlite3.connect(index_path, timeout=SEARCH_INDEX_TIMEOUT)
+    connection.text_factory = str
+    try:
+        version = None
+        if not rebuild:
+            try:
+                version = connection.execute('SELECT value FROM meta '
+                        'WHERE key = ?', ('version', )).fetchone()
+            except sqlite3.DatabaseError:
+                # New or not an index
+                pass
+        if version is None or version[0] != SEARCH_INDEX_VERSION:
+            try:
+                _create_index(connection)
+            except sqlite3.DatabaseError:
+                # Corrupt, start over from an empty file
+                connection.close()
+                remove(index_path)
+                connection = sqlite3.connect(index_path,
+                        timeout=SEARCH_INDEX_TIMEOUT)
+                connection.text_factory = str
+                _create_index(connection)
+    except:
+        connection.close()
+        raise
+    return connection
+
+def _document_stamp(docname, stat_by_name):
+    # The (suffix, mtime, size) of each file of the document, as a string
+    # to store in the index
+    stamp = []
+    for suff in [TEXT_FILE_SUFFIX] + KNOWN_FILE_SUFF + [JOURNAL_FILE_SUFF]:
+        file_stat = stat_by_name.get(docname + '.' + suff)
+        if file_stat is not None:
+            stamp.append((suff, file_stat.st_mtime, file_stat.st_size))
+    return repr(tuple(stamp))
+
+def _terms(text):
+    return set(term.lower() for term in TERM_RE.findall(text))
+
+def _document_index(directory, docname):
+    # The terms and the (kind, type) of the annotations of the document,
+    # None if it cannot be read
+    try:
+        # Indexing goes through every document, keep them out of the cache
+        ann_obj = open_cached_text_annotations(path_join(directory, docname),
+                cache=False)
+    except (AnnotationFileNotFoundError, AnnotationNotFoundError):
+        return None
+    except Exception, e:
+        log_warning('unable to index "%s" for search: %s' % (
+            path_join(directory, docname), e))
+        return None
+
+    terms = _terms(ann_obj.get_document_text())
+    for textbound in ann_obj.get_textbounds():
+        terms.update(_terms(textbound.get_text()))
+
+    types = set()
+    for entity in ann_obj.get_entities():
+        types.add(('entity', entity.type))
+    for event in ann_obj.get_events():
+        types.add(('event', event.type))
+    for relation in ann_obj.get_relations():
+        types.add(('relation', relation.type))
+    for equiv in ann_obj.get_equivs():
+        types.add(('relation', equiv.type))
+    return terms, types
+
+def _delete_document(connection, docname):
+    row = connection.execute('SELECT id FROM documents WHERE name = ?',
+            (docname, )).fetchone()
+    if row is not None:
+        doc_id = row[0]
+        connection.execute('DELETE FROM postings WHERE document = ?',
+                (doc_id, ))
+        connection.execute('DELETE FROM types WHERE document = ?',
+                (doc_id, ))
+        connection.execute('DELETE FROM documents WHERE id = ?', (doc_id, ))
+
+def _index_document(connection, directory, docname, stamp):
+    _delete_document(connection, _stored_name(docname))
+
+    index = _document_index(directory, docname)
+    doc_id = connection.execute('INSERT INTO documents (name, stamp, indexed) '
+            'VALUES (?, ?, ?)', (_stored_name(docname), stamp,
+                index is not None)).lastrowid
+    if index is None:
+        return
+
+    terms, types = index
+    connection.executemany('INSERT OR IGNORE INTO terms (term) VALUES (?)',
+            ((term, ) for term in terms))
+    connection.executemany('INSERT INTO postings '
+            'SELECT id, ? FROM terms WHERE term = ?',
+            ((doc_id, term) for term in terms))
+    connection.executemany('INSERT INTO types VALUES (?, ?, ?)',
+            ((kind, type, doc_id) for kind, type in types))
+
+def _document_exists(stored_name, stat_by_name):
+    # Whether the text file of a document stored in the index is still in
+    # the directory; stat_by_name may be keyed by unicode names
+    for name in (stored_name, stored_name.decode('utf-8')):
+        if stat_by_name.get(name + '.' + TEXT_FILE_SUFFIX) is not None:
+            return True
+    return False
+
+def _update_index(connection, directory, base_names, stat_by_name):
+    # Index the given documents changed since they were indexed and drop
+    # the documents no longer in the directory, returns the number of
+    # documents indexed. Other documents, such as those another user
+    # lists, are left as they are.
+    indexed_stamps = dict(connection.execute(
+        'SELECT name, stamp FROM documents'))
+
+    stale = []
+    for docname in base_names:
+        stamp = _document_stamp(docname, stat_by_name)
+        if indexed_stamps.pop(_stored_name(docname), None) != stamp:
+            stale.append((docname, stamp))
+    removed = [docname for docname in indexed_stamps
+            if not _document_exists(docname, stat_by_name)]
+
+    if stale or removed:
+        log_info('indexing %d documents in "%s" for search' % (len(stale),
+            directory))
+        with connection:
+            for docname in removed:
+                _delete_document(connection, docname)
+            for docname, stamp in stale:
+                _index_document(connection, directory, docname, stamp)
+    return len(stale)
+
+def update_index(directory, base_names, rebuild=False, stat_by_name=None):
+    '''
+    Bring the search index of the given documents in directory up to date,
+    indexing all of them if rebuild is True. Returns the number of
+    documents indexed.
+    '''
+    if stat_by_name is None:
+        stat_by_name = dict(directory_entries(directory))
+    connection = _connect(directory, rebuild)
+    try:
+        return _update_index(connection, directory, base_names, stat_by_name)
+    finally:
+        connection.close()
+
+def _query_terms(text, text_match):
+    # The (term, exact) pairs that any text with a match for text must
+    # have a term for, either equal to term or, if not exact, containing
+    # it. Only word and substring matches can be answered from terms.
+    if text_match not in ('word', 'substring'):
+        return []
+    query_terms = []
+    for m in TERM_RE.finditer(text):
+        # A term delimited within the text is a whole term wherever the
+        # text matches, as is every term of a whole word match
+        exact = (text_match == 'word'
+                or (m.start() > 0 and m.end() < len(text)))
+        query_terms.append((m.group().lower(), exact))
+    return query_terms
+
+def _like_pattern(term):
+    # Terms are words, of which only _ has a special meaning to LIKE
+    return '%' + term.replace('\\', '\\\\').replace('_', '\\_') + '%'
+
+def _matching_document_ids(connection, texts, types):
+    # The ids of the documents having all of the given terms and types
+    selected = []
+    for text, text_match in texts:
+        for term, exact in _query_terms(text, text_match):
+            if exact:
+                rows = connection.execute('SELECT document FROM postings '
+                        'JOIN terms ON terms.id = postings.term '
+                        'WHERE terms.term = ?', (term, ))
+            else:
+                # LIKE ignores case, which the terms are already folded to
+                rows = connection.execute('SELECT DISTINCT document '
+                        'FROM postings JOIN terms ON terms.id = postings.term '
+                        "WHERE terms.term LIKE ? ESCAPE '\\'",
+                        (_like_pattern(term), ))
+            selected.append(set(row[0] for row in rows))
+
+    for kind, type in types:
+        rows = connection.execute('SELECT document FROM types '
+                'WHERE kind = ? AND type = ?', (kind, type))
+        selected.append(set(row[0] for row in rows))
+
+    if not selected:
+        return None
+    selected.sort(key=len)
+    doc_ids = selected[0]
+    for other in selected[1:]:
+        doc_ids &= other
+    return doc_ids
+
+def filter_documents(directory, base_names, texts=(), types=(),
+        stat_by_name=None):
+    '''
+    Return those of the given documents in directory, in the given order,
+    that can have matches for a search requiring matches for all of
+    texts, (text, text_match) pairs with text_match as for search, in the
+    text of the document or of its text-bound annotations and
+    annotations of all of types, (kind, type) pairs where kind is
+    "entity", "event" or "relation".
+
+    All the documents are returned if the index cannot be used.
+    '''
+    texts = [(text, text_match) for text, text_match in texts
+            if text is not None]
+    types = [(kind, type) for kind, type in types if type]
+    if not SEARCH_INDEX or sqlite3 is None or not (texts or types):
+        return base_names
+
+    if stat_by_name is None:
+        stat_by_name = dict(directory_entries(directory))
+    try:
+        connection = _connect(directory)
+        try:
+            _update_index(connection, directory, base_names, stat_by_name)
+            doc_ids = _matching_document_ids(connection, texts, types)
+            if doc_ids is None:
+                return base_names
+            # Documents that could not be indexed are always searched
+            doc_ids.update(row[0] for row in connection.execute(
+                'SELECT id FROM documents WHERE indexed = 0'))
+            docnames = set(name for doc_id, name in connection.execute(
+                'SELECT id, name FROM documents') if doc_id in doc_ids)
+        finally:
+            connection.close()
+    except (sqlite3.Error, IOError, OSError), e:
+        log_warning('unable to use the search index of "%s": %s' % (
+            directory, e))
+        return base_names
+
+    return [docname for docname in base_names
+            if _stored_name(docname) in docnames]
+
+if __name__ == '__main__':
+    from os import mkdir
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    from annotation import open_textfile
+
+    # Users with access to different documents of a collection must not
+    # drop each other's documents from the index
+    WORK_DIR = mkdtemp()
+    try:
+        directory = path_join(WORK_DIR, 'collection')
+        mkdir(directory)
+        for docname, text in (('a', u'alpha'), ('b', u'beta'),
+                ('c', u'gamma')):
+            with open_textfile(path_join(directory, docname + '.txt'),
+                    'w') as txt_file:
+                txt_file.write(text + u'\n')
+            open_textfile(path_join(directory, docname + '.ann'), 'w').close()
+
+        def _indexed_names():
+            connection = _connect(directory)
+            try:
+                return sorted(name for name, in connection.execute(
+                    'SELECT name FROM documents'))
+            finally:
+                connection.close()
+
+        assert update_index(directory, ['a', 'b']) == 2
+        assert update_index(directory, ['b', 'c']) == 1
+        assert update_index(directory, ['a', 'b']) == 0
+        assert _indexed_names() == ['a', 'b', 'c'], _indexed_names()
+        assert filter_documents(directory, ['b', 'c'],
+                texts=[(u'alpha', 'word')]) == []
+        assert filter_documents(directory, ['a', 'b'],
+                texts=[(u'alpha', 'word')]) == ['a']
+
+        # Documents removed from the directory are dropped
+        remove(path_join(directory, 'a.txt'))
+        remove(path_join(directory, 'a.ann'))
+        assert update_index(directory, ['b']) == 0
+        assert _indexed_names() == ['b', 'c'], _indexed_names()
+    finally:
+        rmtree(WORK_DIR)
+    print 'Succesful!'
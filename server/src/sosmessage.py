@@ -35,3 +35,12 @@ class SosMessager:
 
     def debug(msg, duration=3, escaped=False): pass
     debug = staticmethod(debug)
+
+    def pending_count(): return 0
+    pending_count = staticmethod(pending_count)
+
+    def messages_since(count): return ()
+    messages_since = staticmethod(messages_since)
+
+    def add_messages(messages): pass
+    add_messages = staticmethod(add_messages)
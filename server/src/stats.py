@@ -11,15 +11,22 @@ Author:     Pontus Stenetorp    <pontus is s u-tokyo ac jp>
 Version:    2011-04-21
 '''
 
-from cPickle import UnpicklingError
+from cPickle import UnpicklingError, HIGHEST_PROTOCOL
 from cPickle import dump as pickle_dump
 from cPickle import load as pickle_load
+from errno import ENOENT
 from logging import info as log_info
-from os import listdir
-from os.path import isfile, getmtime
+from multiprocessing import Pool, cpu_count
+from os import rename, remove, fdopen
+from os.path import getmtime
 from os.path import join as path_join
+from tempfile import mkstemp
 
-from annotation import Annotations, open_textfile
+from annotation import (open_cached_annotations, open_textfile,
+        iter_annotations, TextBoundAnnotation, EventAnnotation,
+        TEXT_FILE_SUFFIX, KNOWN_FILE_SUFF, JOINED_ANN_FILE_SUFF,
+        JOURNAL_FILE_SUFF)
+from common import directory_entries
 from config import DATA_DIR, BASE_DIR
 from message import Messager
 from projectconfig import get_config_path
@@ -29,8 +36,18 @@ try:
 except ImportError:
     PERFORM_VERIFICATION = False
 
+try:
+    from config import STATS_PROCESSES
+except ImportError:
+    STATS_PROCESSES = None
+
 ### Constants
 STATS_CACHE_FILE_NAME = '.stats_cache'
+# Bump when the format of the statistics cache changes
+STATS_CACHE_VERSION = 4
+# Fewest documents to generate statistics for per worker process, for
+# fewer starting the process does not pay off
+STATS_DOCUMENTS_PER_PROCESS = 200
 ###
 
 def get_stat_cache_by_dir(directory):
@@ -40,94 +57,285 @@ def get_stat_cache_by_dir(directory):
 def get_config_py_path():
     return path_join(BASE_DIR, 'config.py')
 
-# TODO: Quick hack, prettify and use some sort of csv format
-def get_statistics(directory, base_names, use_cache=True):
-    # Check if we have a cache of the costly satistics generation
-    # Also, only use it if no file is newer than the cache itself
-    cache_file_path = get_stat_cache_by_dir(directory)
-
-    try:
-        cache_mtime = getmtime(cache_file_path);
-    except OSError, e:
-        if e.errno == 2:
-            cache_mtime = -1;
+def _annotation_counts(document):
+    # Entity, relation (including equivs) and event counts of a document,
+    # read without loading the document as a whole
+    tb_ids = set()
+    trigger_ids = set()
+    rel_count = 0
+    event_count = 0
+    for ann in iter_annotations(document, kinds=('T', 'E', 'R', '*'),
+            merge_equivs=True):
+        if isinstance(ann, TextBoundAnnotation):
+            tb_ids.add(ann.id)
+        elif isinstance(ann, EventAnnotation):
+            event_count += 1
+            trigger_ids.add(ann.trigger)
         else:
-            raise
+            rel_count += 1
+    # Entities are text-bounds that are not triggers, see Annotations
+    tb_count = len(tb_ids - trigger_ids)
+    return [tb_count, rel_count, event_count]
 
+def _document_stats(directory, docname, stat_types):
+    # The statistics of a single document, -1 for those that could not be
+    # generated
     try:
-        if (not isfile(cache_file_path)
-                # Has config.py been changed?
-                or getmtime(get_config_py_path()) > cache_mtime
-                # Any file has changed in the dir since the cache was generated
-                or any(True for f in listdir(directory)
-                    if (getmtime(path_join(directory, f)) > cache_mtime
-                    # Ignore hidden files
-                    and not f.startswith('.')))
-                # The configuration is newer than the cache
-                or getmtime(get_config_path(directory)) > cache_mtime):
-            generate = True
-            docstats = []
-        else:
-            generate = False
+        if not PERFORM_VERIFICATION:
+            # Counting does not need the document as a whole
+            return _annotation_counts(path_join(directory, docname))
+
+        from verify_annotations import (verify_annotation,
+                compiled_configuration)
+        # Statistics go through every document, keep them out of the cache
+        with open_cached_annotations(path_join(directory, docname),
+                cache=False) as ann_obj:
+            tb_count = len([a for a in ann_obj.get_entities()])
+            rel_count = (len([a for a in ann_obj.get_relations()]) +
+                         len([a for a in ann_obj.get_equivs()]))
+            event_count = len([a for a in ann_obj.get_events()])
+
+            # verify and include verification issue count
             try:
-                with open(cache_file_path, 'rb') as cache_file:
-                    docstats = pickle_load(cache_file)
-            except UnpicklingError:
-                # Corrupt data, re-generate
-                Messager.warning('Stats cache %s was corrupted; regenerating' % cache_file_path, -1)
-                generate = True
-            except EOFError:
-                # Corrupt data, re-generate
-                generate = True
-    except OSError, e:
-        Messager.warning('Failed checking file modification times for stats cache check; regenerating')
-        generate = True
+                issues = verify_annotation(ann_obj,
+                        compiled_configuration(directory))
+                issue_count = len(issues)
+            except:
+                # TODO: error reporting
+                issue_count = -1
+            return [tb_count, rel_count, event_count, issue_count]
+    except Exception, e:
+        log_info('Received "%s" when trying to generate stats' % e)
+        # Pass exceptions silently, just marking stats missing
+        return [-1] * len(stat_types)
+
+def _document_stats_task(task):
+    # _document_stats as run by the worker processes of _generate_stats
+    directory, docname, stat_types = task
+    return docname, _document_stats(directory, docname, stat_types)
+
+def _stats_processes(processes):
+    if processes is None:
+        processes = STATS_PROCESSES
+    if processes is None:
+        try:
+            return cpu_count()
+        except NotImplementedError:
+            return 1
+    return processes
+
+def _generate_stats(directory, docnames, stat_types, processes=1):
+    # The statistics of the given documents by document name, generated
+    # by a pool of up to processes worker processes (STATS_PROCESSES if
+    # None) if there are enough documents. Only tools ask for worker
+    # processes: forked from a request handler they would inherit the
+    # connections of the server and the locks held by its other threads.
+    processes = min(_stats_processes(processes),
+            len(docnames) // STATS_DOCUMENTS_PER_PROCESS)
+    if processes > 1:
+        try:
+            pool = Pool(processes)
+        except OSError, e:
+            log_info('Could not start statistics worker processes: %s' % e)
+            processes = 1
+
+    if processes <= 1:
+        return dict((docname, _document_stats(directory, docname,
+            stat_types)) for docname in docnames)
+
+    tasks = [(directory, docname, stat_types) for docname in docnames]
+    # Several chunks per process to even out differences in document size
+    chunksize = max(1, len(tasks) // (processes * 4))
+    try:
+        stats_by_docname = dict(pool.imap_unordered(_document_stats_task,
+            tasks, chunksize))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return stats_by_docname
+
+def _getmtime_or_none(path):
+    if path is None:
+        return None
+    try:
+        return getmtime(path)
+    except OSError:
+        return None
+
+def _stats_config_version(directory):
+    # Only the verification issue counts depend on the configuration
+    if not PERFORM_VERIFICATION:
+        return None
+    return (_getmtime_or_none(get_config_py_path()),
+            _getmtime_or_none(get_config_path(directory)))
+
+def _document_stamp(docname, stat_by_name):
+    # (suffix, mtime, size) of each annotation file of the document, from
+    # the status of the entries of its directory by name
+    stamp = []
+    for suff in KNOWN_FILE_SUFF + [JOURNAL_FILE_SUFF]:
+        file_stat = stat_by_name.get(docname + '.' + suff)
+        if file_stat is not None:
+            stamp.append((suff, file_stat.st_mtime, file_stat.st_size))
+    return tuple(stamp)
+
+def _document_mtime(stamp):
+    # The time the annotations of the document were last modified, as
+    # listed for the document by get_directory_information
+    mtimes = [mtime for suff, mtime, _ in stamp
+            if suff in (JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF)]
+    return max(mtimes) if mtimes else -1
+
+def _load_stats_cache(cache_file_path, config_version):
+    # The cache, None if there is no usable cache
+    try:
+        with open(cache_file_path, 'rb') as cache_file:
+            cache = pickle_load(cache_file)
+    except IOError, e:
+        if e.errno != ENOENT:
+            Messager.warning('Could not read stats cache %s: %s; regenerating'
+                    % (cache_file_path, e), -1)
+        return None
+    except (UnpicklingError, EOFError, ValueError):
+        # Corrupt data, re-generate
+        Messager.warning('Stats cache %s was corrupted; regenerating'
+                % cache_file_path, -1)
+        return None
+
+    # Caches in an older format or for another configuration are stale
+    if (not isinstance(cache, dict)
+            or cache.get('version') != STATS_CACHE_VERSION
+            or cache.get('config') != config_version):
+        return None
+    return cache
+
+def _store_stats_cache(directory, cache):
+    # Write to a temporary file and rename it into place so that
+    # concurrent listings never read a partial cache
+    try:
+        tmp_fd, tmp_path = mkstemp(dir=directory, prefix=STATS_CACHE_FILE_NAME)
+        try:
+            with fdopen(tmp_fd, 'wb') as tmp_file:
+                pickle_dump(cache, tmp_file, HIGHEST_PROTOCOL)
+            rename(tmp_path, get_stat_cache_by_dir(directory))
+        except:
+            remove(tmp_path)
+            raise
+    except (IOError, OSError), e:
+        Messager.warning("Could not write statistics cache file to directory %s: %s" % (directory, e))
+
+def _get_stats_cache(directory, base_names, use_cache, stat_by_name,
+        processes=1):
+    # The (stamp, statistics) of each document of the directory by name
+    # from its statistics cache, brought up to date for the given
+    # documents, so that only the documents changed since the cache was
+    # written need to be read again. Documents not among base_names, such
+    # as those the user may not read, are kept in the cache for as long
+    # as they are in the directory, so that listings of different
+    # documents of the directory do not keep dropping each other's.
+    config_version = _stats_config_version(directory)
 
     # "header" and types
     stat_types = [("Entities", "int"), ("Relations", "int"), ("Events", "int")]
     if PERFORM_VERIFICATION:
         stat_types.append(("Issues", "int"))
-            
-    if generate:
-        # Generate the document statistics from scratch
-        from annotation import JOINED_ANN_FILE_SUFF
-        log_info('generating statistics for "%s"' % directory)
-        docstats = []
-        for docname in base_names:
-            try:
-                with Annotations(path_join(directory, docname), 
-                        read_only=True) as ann_obj:
-                    tb_count = len([a for a in ann_obj.get_entities()])
-                    rel_count = (len([a for a in ann_obj.get_relations()]) +
-                                 len([a for a in ann_obj.get_equivs()]))
-                    event_count = len([a for a in ann_obj.get_events()])
-
-                    if not PERFORM_VERIFICATION:
-                        docstats.append([tb_count, rel_count, event_count])
-                    else:
-                        # verify and include verification issue count
-                        try:
-                            from projectconfig import ProjectConfiguration
-                            projectconf = ProjectConfiguration(directory)
-                            from verify_annotations import verify_annotation
-                            issues = verify_annotation(ann_obj, projectconf)
-                            issue_count = len(issues)
-                        except:
-                            # TODO: error reporting
-                            issue_count = -1
-                        docstats.append([tb_count, rel_count, event_count, issue_count])
-            except Exception, e:
-                log_info('Received "%s" when trying to generate stats' % e)
-                # Pass exceptions silently, just marking stats missing
-                docstats.append([-1] * len(stat_types))
-
-        # Cache the statistics
+
+    cache = None
+    if use_cache:
+        cache = _load_stats_cache(get_stat_cache_by_dir(directory),
+                config_version)
+    if cache is None:
+        cache = {
+                'version': STATS_CACHE_VERSION,
+                'config': config_version,
+                'documents': {},
+                }
+    cached_docs = cache['documents']
+
+    if stat_by_name is None:
+        stat_by_name = dict(directory_entries(directory))
+    docs = {}
+    stale = []
+    for docname in base_names:
+        stamp = _document_stamp(docname, stat_by_name)
         try:
-            with open(cache_file_path, 'wb') as cache_file:
-                pickle_dump(docstats, cache_file)
-        except IOError, e:
-            Messager.warning("Could not write statistics cache file to directory %s: %s" % (directory, e))
+            cached_stamp, docstats = cached_docs[docname]
+        except KeyError:
+            pass
+        else:
+            if cached_stamp == stamp:
+                docs[docname] = (cached_stamp, docstats)
+                continue
+        stale.append((docname, stamp))
+
+    if stale:
+        log_info('generating statistics for %d documents in "%s"' % (
+                len(stale), directory))
+        stats_by_docname = _generate_stats(directory,
+                [docname for docname, _ in stale], stat_types, processes)
+        for docname, stamp in stale:
+            # The stamp is from before reading, a change made while
+            # reading will be caught the next time around
+            docs[docname] = (stamp, stats_by_docname[docname])
+
+    # Keep the other documents still in the directory, but drop the rest
+    dropped = False
+    for docname, cached in cached_docs.iteritems():
+        if docname not in docs:
+            if docname + '.' + TEXT_FILE_SUFFIX in stat_by_name:
+                docs[docname] = cached
+            else:
+                dropped = True
+
+    if stale or dropped:
+        cache['documents'] = docs
+        _store_stats_cache(directory, cache)
+
+    return stat_types, docs
+
+# TODO: Quick hack, prettify and use some sort of csv format
+def get_statistics(directory, base_names, use_cache=True, stat_by_name=None,
+        processes=1):
+    # stat_by_name maps the entries of the directory to their status (see
+    # directory_entries) for callers that have already listed it, and
+    # tools can have the statistics generated by processes worker
+    # processes (STATS_PROCESSES if None), see _generate_stats
+    stat_types, docs = _get_stats_cache(directory, base_names, use_cache,
+            stat_by_name, processes)
+    return stat_types, [docs[docname][1] for docname in base_names]
+
+def get_sorted_statistics(directory, base_names, sort_by, descending=False,
+        use_cache=True, stat_by_name=None):
+    '''
+    As get_statistics, but returns the stat types, the given document
+    names sorted by sort_by and the statistics by document name. sort_by
+    is "Document", "Modified" or the name of a stat type, documents
+    sorting equal are in order of their names.
+
+    Raises ValueError for an unknown sort_by.
+    '''
+    stat_types, docs = _get_stats_cache(directory, base_names, use_cache,
+            stat_by_name)
+
+    if sort_by == 'Document':
+        order = sorted(base_names, reverse=descending)
+    else:
+        if sort_by == 'Modified':
+            value = lambda docname: _document_mtime(docs[docname][0])
+        else:
+            stat_names = [name for name, _ in stat_types]
+            if sort_by not in stat_names:
+                raise ValueError('unknown sort column "%s"' % sort_by)
+            i = stat_names.index(sort_by)
+            value = lambda docname: docs[docname][1][i]
+        sign = -1 if descending else 1
+        order = sorted(base_names,
+                key=lambda docname: (sign * value(docname), docname))
 
-    return stat_types, docstats
+    return stat_types, order, dict((docname, docs[docname][1])
+            for docname in base_names)
 
 # TODO: Testing!
@@ -17,7 +17,7 @@ from common import ProtocolError
 from document import real_directory
 from message import Messager
 from annotation import TextAnnotations, TextBoundAnnotationWithText
-from annotator import _json_from_ann, ModificationTracker
+from annotator import _attach_annotations, ModificationTracker
 
 try:
     from config import NER_TAGGING_SERVICES
@@ -31,7 +31,7 @@ class UnknownTaggerError(ProtocolError):
         json_dic['exception'] = 'unknownTaggerError'
 
 
-def tag(collection, document, tagger):
+def tag(collection, document, tagger, delta='false'):
     for tagger_token, _, _, tagger_service_url in NER_TAGGING_SERVICES:
         if tagger == tagger_token:
             mods = ModificationTracker()
@@ -59,8 +59,7 @@ def tag(collection, document, tagger):
                     ann_obj.add_annotation(tb)
                 ### END: Dummy part
                 resp = mods.json_response()
-                resp['annotations'] = _json_from_ann(ann_obj)
-                return resp
+                return _attach_annotations(resp, ann_obj, mods, delta)
     else:
         raise UnknownTaggerError
     assert False, 'not a reachable state' 
@@ -6,6 +6,8 @@
 
 from __future__ import with_statement
 
+import re
+
 import annotation
 
 from projectconfig import ProjectConfiguration, ENTITY_NESTING_TYPE
@@ -15,6 +17,9 @@ AnnotationError = "AnnotationError"
 AnnotationWarning = "AnnotationWarning"
 AnnotationIncomplete = "AnnotationIncomplete"
 
+# Argument role without trailing numbers (e.g. "Theme1" -> "Theme")
+NONUM_ARG_RE = re.compile(r'^(.*?)\d*$')
+
 class AnnotationIssue:
     """
     Represents an issue noted in verification of annotations.
@@ -35,16 +40,112 @@ class AnnotationIssue:
     def __str__(self):
         return "%s\t%s %s\t%s" % (self.id, self.type, self.ann_id, self.description)
 
+class CompiledProjectConfiguration(object):
+    """
+    Wraps a ProjectConfiguration, answering the type lookups made in
+    verification from tables filled in on first use instead of walking
+    the type hierarchies for every annotation. Only valid while the
+    wrapped configuration is unchanged; see compiled_configuration().
+    The returned values are shared and must not be modified.
+    """
+
+    def __init__(self, projectconf):
+        self.projectconf = projectconf
+        self.directory = projectconf.directory
+        self.__event_types = projectconf.get_event_types()
+        self.__entity_types = projectconf.get_entity_types()
+        self.__relation_types = projectconf.get_relation_types()
+        self.__event_type_set = frozenset(self.__event_types)
+        self.__equiv_type_set = frozenset(projectconf.get_equiv_types())
+        self.__table = {}
+
+    def __lookup(self, method, *args):
+        key = (method, ) + args
+        try:
+            return self.__table[key]
+        except KeyError:
+            value = getattr(self.projectconf, method)(*args)
+            self.__table[key] = value
+            return value
+
+    def get_event_types(self):
+        return self.__event_types
+
+    def get_entity_types(self):
+        return self.__entity_types
+
+    def get_relation_types(self):
+        return self.__relation_types
+
+    def is_event_type(self, t):
+        return t in self.__event_type_set
+
+    def is_equiv_type(self, t):
+        return t in self.__equiv_type_set
+
+    def is_physical_entity_type(self, t):
+        return self.__lookup('is_physical_entity_type', t)
+
+    def preferred_display_form(self, t):
+        return self.__lookup('preferred_display_form', t)
+
+    def mandatory_arguments(self, atype):
+        return self.__lookup('mandatory_arguments', atype)
+
+    def multiple_allowed_arguments(self, atype):
+        return self.__lookup('multiple_allowed_arguments', atype)
+
+    def argument_minimum_count(self, atype, arg):
+        return self.__lookup('argument_minimum_count', atype, arg)
+
+    def argument_maximum_count(self, atype, arg):
+        return self.__lookup('argument_maximum_count', atype, arg)
+
+    def arc_types_from(self, from_ann):
+        return self.__lookup('arc_types_from', from_ann)
+
+    def arc_types_from_to(self, from_ann, to_ann="<ANY>"):
+        return self.__lookup('arc_types_from_to', from_ann, to_ann)
+
+    def relation_types_from_to(self, from_ann, to_ann, include_special=False):
+        return self.__lookup('relation_types_from_to', from_ann, to_ann,
+                include_special)
+
+    def attributes_for(self, ann_type):
+        return self.__lookup('attributes_for', ann_type)
+
+def compiled_configuration(directory):
+    """
+    Returns a CompiledProjectConfiguration for the given directory,
+    shared by the calls made until the project configuration that it
+    wraps is read anew.
+    """
+    from projectconfig import get_annotation_configs, get_visual_configs
+
+    # The configuration readers return the same objects for as long as
+    # the configuration files stay the same
+    configs = (get_annotation_configs(directory),
+            get_visual_configs(directory))
+    try:
+        cached_configs, compiled = compiled_configuration.__cache[directory]
+        if all(c is cc for c, cc in zip(configs, cached_configs)):
+            return compiled
+    except KeyError:
+        pass
+
+    compiled = CompiledProjectConfiguration(ProjectConfiguration(directory))
+    compiled_configuration.__cache[directory] = (configs, compiled)
+    return compiled
+compiled_configuration.__cache = {}
+
 def event_nonum_args(e):
     """
     Given an EventAnnotatation, returns its arguments without trailing
     numbers (e.g. "Theme1" -> "Theme").
     """
-    from re import match as re_match
-
     nna = {}
     for arg, aid in e.args:
-        m = re_match(r'^(.*?)\d*$', arg)
+        m = NONUM_ARG_RE.match(arg)
         if m:
             arg = m.group(1)
         if arg not in nna:
@@ -58,11 +159,9 @@ def event_nonum_arg_count(e):
     of its argument without trailing numbers (e.g. "Theme1" ->
     "Theme") the number of times the argument appears.
     """
-    from re import match as re_match
-
     nnc = {}
     for arg, aid in e.args:
-        m = re_match(r'^(.*?)\d*$', arg)
+        m = NONUM_ARG_RE.match(arg)
         if m:
             arg = m.group(1)
         nnc[arg] = nnc.get(arg, 0) + 1
@@ -73,16 +172,23 @@ def check_textbound_overlap(anns):
     Checks for overlap between the given TextBoundAnnotations.
     Returns a list of pairs of overlapping annotations.
     """
-    overlapping = []
-
-    for a1 in anns:
-        for a2 in anns:
-            if a1 is a2:
-                continue
-            if a2.start < a1.end and a2.end > a1.start:
-                overlapping.append((a1,a2))
-
-    return overlapping
+    # Sweep over the annotations in order of start offset, keeping those
+    # that have not ended yet as candidates for overlapping the next ones
+    overlapping_idxs = []
+    active = []
+    for i in sorted(xrange(len(anns)), key=lambda i: anns[i].start):
+        a1 = anns[i]
+        active = [j for j in active if anns[j].end > a1.start]
+        for j in active:
+            # Explicit check as an empty span overlaps nothing starting at it
+            if anns[j].start < a1.end:
+                overlapping_idxs.append((i, j))
+                overlapping_idxs.append((j, i))
+        active.append(i)
+
+    # Pairs in the order of the given annotations, as for a pairwise check
+    overlapping_idxs.sort()
+    return [(anns[i], anns[j]) for i, j in overlapping_idxs]
 
 def contained_in_span(a1, a2):
     """
@@ -163,9 +269,9 @@ def verify_entity_overlap(ann_obj, projectconf):
 def verify_annotation_types(ann_obj, projectconf):
     issues = []
 
-    event_types = projectconf.get_event_types()
-    textbound_types = event_types + projectconf.get_entity_types()
-    relation_types = projectconf.get_relation_types()
+    event_types = set(projectconf.get_event_types())
+    textbound_types = event_types | set(projectconf.get_entity_types())
+    relation_types = set(projectconf.get_relation_types())
 
     # shortcut
     def disp(s):
@@ -385,7 +491,7 @@ def main(argv=None):
 
     for fn in arg.files:
         try:
-            projectconf = ProjectConfiguration(os.path.dirname(fn))
+            projectconf = compiled_configuration(os.path.dirname(fn))
             # remove ".a2" or ".rel" suffixes for Annotations to prompt
             # parsing of .a1 also.
             # (TODO: temporarily removing .ann also to work around a
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+# Micro-benchmarks for the annotation storage in server/src/annotation.py,
+# run on synthetic documents so that results are comparable across trees.
+
+# Usage example:
+
+#     python tools/annbench.py delete --lines 50000 --delete 10000
+#     python tools/annbench.py memory --documents 10000 --lines 50
+#     python tools/annbench.py search --documents 10000 --lines 50
+#     python tools/annbench.py parse --repeat 3 example-data/*.tar.gz
+#     python tools/annbench.py equiv --lines 10000
+
+from __future__ import with_statement
+
+import sys
+import os
+from contextlib import closing
+from glob import glob
+from time import time
+from tempfile import mkdtemp
+from shutil import rmtree
+
+try:
+    import annotation
+except ImportError:
+    import os.path
+    from sys import path as sys_path
+    # Guessing that we might be in the brat tools/ directory ...
+    sys_path.append(os.path.join(os.path.dirname(__file__), '../server/src'))
+    import annotation
+
+def _write_document(directory, lines):
+    path = os.path.join(directory, 'bench.ann')
+    with annotation.open_textfile(path, 'w') as ann_file:
+        for line in lines:
+            ann_file.write(line + u'\n')
+    return path
+
+def _textbound_lines(count):
+    for i in xrange(1, count + 1):
+        yield u'T%d\tProtein %d %d\tp%d' % (i, i * 10, i * 10 + 5, i)
+
+def _write_text_document(directory, name, count):
+    # A document with count text-bounds on the text, and an event, a
+    # relation and an attribute for every few of them
+    tokens = [u'p%d' % i for i in xrange(1, count + 1)]
+    with annotation.open_textfile(os.path.join(directory, name + '.txt'),
+            'w') as txt_file:
+        txt_file.write(u' '.join(tokens) + u'\n')
+
+    lines = []
+    offset = 0
+    for i, token in enumerate(tokens, 1):
+        lines.append(u'T%d\t%s %d %d\t%s' % (i,
+            'Binding' if i % 5 == 1 else 'Protein', offset,
+            offset + len(token), token))
+        offset += len(token) + 1
+    for i in xrange(1, count - 2, 5):
+        lines.append(u'E%d\tBinding:T%d Theme:T%d' % (i, i, i + 1))
+        lines.append(u'R%d\tEquiv Arg1:T%d Arg2:T%d' % (i, i + 1, i + 2))
+        lines.append(u'A%d\tNegation E%d' % (i, i))
+    with annotation.open_textfile(os.path.join(directory, name + '.ann'),
+            'w') as ann_file:
+        for line in lines:
+            ann_file.write(line + u'\n')
+    return len(lines)
+
+def _peak_rss():
+    # In kilobytes on Linux
+    from resource import getrusage, RUSAGE_SELF
+    return getrusage(RUSAGE_SELF).ru_maxrss
+
+def bench_memory(directory, options):
+    # Load a whole collection at once, as collection search does
+    line_count = 0
+    for i in xrange(options.documents):
+        line_count += _write_text_document(directory, 'doc%d' % i,
+                options.lines)
+
+    start_rss = _peak_rss()
+    start = time()
+    anns = [annotation.TextAnnotations(os.path.join(directory, 'doc%d' % i),
+        read_only=True) for i in xrange(options.documents)]
+    elapsed = time() - start
+    rss = _peak_rss() - start_rss
+
+    assert sum(len(ann_obj) for ann_obj in anns) == line_count
+    print 'loaded %d documents with %d lines' % (options.documents,
+            line_count)
+    print '%.3f seconds, peak RSS grew by %.1f MB (%.0f bytes per line)' % (
+            elapsed, rss / 1024.0, rss * 1024.0 / line_count)
+
+def bench_search(directory, options):
+    # Load a whole collection through the reading of collection search
+    # (search.__directory_to_annotations), which lists the collection and
+    # opens the documents through the annotation cache. The collection has
+    # to be under DATA_DIR, so the given directory is not used.
+    import search
+    from config import DATA_DIR
+    from session import init_session
+
+    # Listing checks read access against the session, as for a request
+    init_session('127.0.0.1')
+
+    collection_dir = mkdtemp(dir=DATA_DIR)
+    try:
+        line_count = 0
+        for i in xrange(options.documents):
+            line_count += _write_text_document(collection_dir, 'doc%d' % i,
+                    options.lines)
+        collection = '/' + os.path.relpath(collection_dir, DATA_DIR)
+
+        start_rss = _peak_rss()
+        start = time()
+        anns = list(search.__directory_to_annotations(collection))
+        elapsed = time() - start
+        rss = _peak_rss() - start_rss
+    finally:
+        rmtree(collection_dir)
+
+    assert sum(len(ann_obj) for ann_obj in anns) == line_count
+    print 'loaded %d documents with %d lines through search' % (
+            options.documents, line_count)
+    print '%.3f seconds, peak RSS grew by %.1f MB (%.0f bytes per line)' % (
+            elapsed, rss / 1024.0, rss * 1024.0 / line_count)
+
+def _corpus_documents(directory, paths):
+    # Annotation documents (paths without suffix) in the given directories
+    # and .tar.gz archives, the latter extracted under directory
+    import tarfile
+
+    documents = set()
+    for i, path in enumerate(paths):
+        if path.endswith('.tar.gz'):
+            root = os.path.join(directory, 'corpus%d' % i)
+            with closing(tarfile.open(path)) as archive:
+                archive.extractall(root)
+        else:
+            root = path
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                base, ext = os.path.splitext(filename)
+                if ext[1:] in annotation.KNOWN_FILE_SUFF:
+                    documents.add(os.path.join(dirpath, base))
+    return sorted(documents)
+
+def bench_parse(directory, options):
+    documents = _corpus_documents(directory, options.corpus or
+            glob(os.path.join(os.path.dirname(__file__),
+                '../example-data/*.tar.gz')))
+
+    best = None
+    for _ in xrange(options.repeat):
+        line_count = 0
+        start = time()
+        for document in documents:
+            line_count += len(annotation.Annotations(document, read_only=True))
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    print 'parsed %d documents with %d lines (best of %d)' % (len(documents),
+            line_count, options.repeat)
+    print '%.3f seconds, %.0f lines per second' % (best, line_count / best)
+
+def bench_equiv(directory, options):
+    # Equivs over pairs of text-bounds, every tenth of which shares a
+    # text-bound with the one before it so that merging is exercised
+    lines = list(_textbound_lines(2 * options.lines))
+    for i in xrange(1, options.lines + 1):
+        first = 2 * i - 1 if i % 10 else 2 * i - 2
+        lines.append(u'*\tEquiv T%d T%d' % (first, 2 * i))
+    path = _write_document(directory, lines)
+
+    start = time()
+    ann_obj = annotation.Annotations(path)
+    elapsed = time() - start
+
+    equiv_count = len(list(ann_obj.get_equivs()))
+    assert equiv_count == options.lines - options.lines / 10
+    print 'read %d equiv lines into %d equivs' % (options.lines, equiv_count)
+    print '%.3f seconds, %.1f microseconds per equiv line' % (elapsed,
+            elapsed / options.lines * 10**6)
+
+def bench_delete(directory, options):
+    # Attach an attribute to each text-bound to delete, as that is what
+    # makes a delete recurse in practice
+    lines = list(_textbound_lines(options.lines))
+    lines.extend(u'A%d\tNegation T%d' % (i, i)
+            for i in xrange(1, options.delete + 1))
+    path = _write_document(directory, lines)
+
+    ann_obj = annotation.Annotations(path)
+    # Deleting from the start of the document is the worst case for any
+    # bookkeeping by line number
+    to_delete = [ann_obj.get_ann_by_id(u'T%d' % i)
+            for i in xrange(1, options.delete + 1)]
+
+    start = time()
+    for ann in to_delete:
+        ann_obj.del_annotation(ann)
+    elapsed = time() - start
+
+    assert len(ann_obj) == len(lines) - 2 * options.delete
+    print 'deleted %d annotations (and %d attributes) from %d lines' % (
+            options.delete, options.delete, len(lines))
+    print '%.3f seconds, %.1f microseconds per delete' % (elapsed,
+            elapsed / options.delete * 10**6)
+
+DEFAULT_LINES = {
+        'delete': 50000,
+        'equiv': 10000,
+        'memory': 50,
+        'parse': None,
+        'search': 50,
+        }
+
+BENCHMARKS = {
+        'delete': bench_delete,
+        'equiv': bench_equiv,
+        'memory': bench_memory,
+        'parse': bench_parse,
+        'search': bench_search,
+        }
+
+def argparser():
+    import argparse
+
+    ap=argparse.ArgumentParser(description="Benchmark annotation storage operations on a synthetic document.")
+    ap.add_argument("benchmark", metavar="BENCHMARK", choices=sorted(BENCHMARKS), help="Benchmark to run (%s)." % ", ".join(sorted(BENCHMARKS)))
+    ap.add_argument("-l", "--lines", type=int, default=None, help="Number of text-bound lines per document (default 50000 for delete, 50 for memory and search), or equiv lines for equiv (default 10000).")
+    ap.add_argument("-d", "--delete", type=int, default=10000, help="Number of annotations to delete.")
+    ap.add_argument("-n", "--documents", type=int, default=10000, help="Number of documents to load.")
+    ap.add_argument("-r", "--repeat", type=int, default=3, help="Number of times to parse the corpus, the best time is reported.")
+    ap.add_argument("corpus", metavar="CORPUS", nargs="*", help="Directories and .tar.gz archives to parse (default: the example data).")
+    return ap
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    options = argparser().parse_args(argv[1:])
+    if options.lines is None:
+        options.lines = DEFAULT_LINES[options.benchmark]
+
+    directory = mkdtemp()
+    try:
+        BENCHMARKS[options.benchmark](directory, options)
+    finally:
+        rmtree(directory)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
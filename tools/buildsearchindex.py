@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+# Brings the search indexes of collections up to date, so that the first
+# search of a collection after a bulk import does not have to index all
+# of its documents. Use --rebuild to index every document again.
+
+# Usage example:
+
+#     python tools/buildsearchindex.py -r data/my_collection
+
+from __future__ import with_statement
+
+import sys
+import os.path
+
+# this seems to be necessary for the server modules to find their config
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+try:
+    import searchindex
+except ImportError:
+    from sys import path as sys_path
+    # Guessing that we might be in the brat tools/ directory ...
+    sys_path.append(os.path.join(os.path.dirname(__file__), '../server/src'))
+    import searchindex
+
+from common import collection_directories, collection_document_names
+
+def argparser():
+    import argparse
+
+    ap=argparse.ArgumentParser(description="Index the documents of collections for search.")
+    ap.add_argument("-r", "--recursive", default=False, action="store_true", help="Also process the collections in subdirectories.")
+    ap.add_argument("--rebuild", default=False, action="store_true", help="Index all documents, not only those changed since they were indexed.")
+    ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Verbose output.")
+    ap.add_argument("directories", metavar="DIR", nargs="+", help="Collection directories to process.")
+    return ap
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    options = argparser().parse_args(argv[1:])
+
+    if searchindex.sqlite3 is None:
+        print >> sys.stderr, "Search indexes require the sqlite3 module"
+        return 1
+
+    for root in options.directories:
+        for directory in collection_directories(os.path.abspath(root),
+                options.recursive):
+            try:
+                base_names = collection_document_names(directory)
+                indexed = searchindex.update_index(directory, base_names,
+                        rebuild=options.rebuild)
+            except (OSError, searchindex.sqlite3.Error), e:
+                print >> sys.stderr, "%s:\tFailed: %s" % (directory, e)
+                continue
+            if options.verbose:
+                print >> sys.stderr, '%s: indexed %d of %d documents' % (
+                        directory, indexed, len(base_names))
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -94,6 +94,8 @@ def main(argv):
     texts = []
     for fn in filenames:
         assert re.search(r'\.ann$', fn), 'Error: argument %s not a .ann file.' % fn
+        # edits journaled by the brat server are not in the file itself
+        assert not os.path.exists(fn + '.journal'), 'Error: unapplied edits in %s.journal, run tools/compactjournal.py on %s first.' % (fn, fn)
         txtfn = re.sub(r'\.ann$', '.txt', fn)
 
         with open(fn, 'r') as annf:
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+# Folds the journals written when ANNOTATION_JOURNAL is enabled back into
+# their annotation files. Run this before processing the annotation files
+# with tools that read them directly and thus do not see the journals.
+
+# Usage example:
+
+#     python tools/compactjournal.py data/my_collection/*.ann
+
+from __future__ import with_statement
+
+import sys
+import os.path
+try:
+    import annotation
+except ImportError:
+    from sys import path as sys_path
+    # Guessing that we might be in the brat tools/ directory ...
+    sys_path.append(os.path.join(os.path.dirname(__file__), '../server/src'))
+    import annotation
+
+# this seems to be necessary for annotations to find its config
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+def argparser():
+    import argparse
+
+    ap=argparse.ArgumentParser(description="Fold annotation journals back into their annotation files.")
+    ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Verbose output.")
+    ap.add_argument("files", metavar="FILE", nargs="+", help="Files to process (DOCUMENT.ann or DOCUMENT.ann.journal).")
+    return ap
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    options = argparser().parse_args(argv[1:])
+
+    compacted = 0
+    for fn in options.files:
+        # remove suffixes, the journal is found from the annotation file
+        nosuff_fn = fn
+        for suff in (annotation.JOURNAL_FILE_SUFF,
+                annotation.JOINED_ANN_FILE_SUFF):
+            if nosuff_fn.endswith('.' + suff):
+                nosuff_fn = nosuff_fn[:-len(suff) - 1]
+                break
+
+        try:
+            if annotation.compact_annotation_journal(nosuff_fn):
+                compacted += 1
+                if options.verbose:
+                    print >> sys.stderr, 'compacted', fn
+        except annotation.AnnotationFileNotFoundError:
+            print >> sys.stderr, "%s:\tFailed: file not found" % fn
+        except annotation.AnnotationNotFoundError, e:
+            print >> sys.stderr, "%s:\tFailed: %s" % (fn, e)
+
+    if options.verbose:
+        print >> sys.stderr, 'compacted %d journals' % compacted
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
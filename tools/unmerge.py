@@ -172,6 +172,11 @@ def write_annotation_lines(fn, lines):
             f.write(l)
 
 def read_annotation_lines(fn):
+    import os.path
+
+    # edits journaled by the brat server are not in the file itself
+    if os.path.exists(fn + '.journal'):
+        raise IOError("unapplied edits in %s.journal, run tools/compactjournal.py on %s first" % (fn, fn))
     with open(fn) as f:
         return f.readlines()
 
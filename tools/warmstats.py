@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+# Brings the statistics caches of collections up to date, so that the
+# first listing of a collection after a bulk import does not have to
+# generate the statistics of all of its documents. Also removes the
+# cached sentence and token offsets of documents that no longer exist.
+
+# Usage example:
+
+#     python tools/warmstats.py -r data/my_collection
+
+from __future__ import with_statement
+
+import sys
+import os.path
+
+# this seems to be necessary for the server modules to find their config
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+try:
+    import stats
+except ImportError:
+    from sys import path as sys_path
+    # Guessing that we might be in the brat tools/ directory ...
+    sys_path.append(os.path.join(os.path.dirname(__file__), '../server/src'))
+    import stats
+
+from common import collection_directories, collection_document_names
+from document import prune_text_offsets_cache
+
+def argparser():
+    import argparse
+
+    ap=argparse.ArgumentParser(description="Generate the document statistics of collections ahead of their listing.")
+    ap.add_argument("-r", "--recursive", default=False, action="store_true", help="Also process the collections in subdirectories.")
+    ap.add_argument("-p", "--processes", type=int, default=None, help="Number of worker processes (default: STATS_PROCESSES from config.py, or one per CPU core).")
+    ap.add_argument("-v", "--verbose", default=False, action="store_true", help="Verbose output.")
+    ap.add_argument("directories", metavar="DIR", nargs="+", help="Collection directories to process.")
+    return ap
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    options = argparser().parse_args(argv[1:])
+
+    for root in options.directories:
+        for directory in collection_directories(os.path.abspath(root),
+                options.recursive):
+            try:
+                base_names = collection_document_names(directory)
+                stats.get_statistics(directory, base_names,
+                        processes=options.processes)
+            except OSError, e:
+                print >> sys.stderr, "%s:\tFailed: %s" % (directory, e)
+                continue
+            if options.verbose:
+                print >> sys.stderr, '%s: %d documents' % (directory,
+                        len(base_names))
+
+    removed = prune_text_offsets_cache()
+    if options.verbose:
+        print >> sys.stderr, 'removed %d stale offsets cache entries' % removed
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))